@@ -0,0 +1,163 @@
+"""
+adsb-bin: compact binary delta subprotocol
+
+One websocket message per update tick: a version byte followed by one
+record per aircraft. A record starts with a little-endian uint32 holding
+the icao24 in its low 24 bits and the presence mask in its high 8 bits,
+followed by the fields whose bit is set, in this order:
+
+    bit   field       type      unit
+    0x01  callsign    char[8]   space padded ASCII
+    0x02  squawk      uint16    the 4 digits as decimal number, 7421
+    0x04  altitude    int16     25 ft
+    0x08  speed       uint16    0.1 kt
+    0x10  track       uint16    0.01 degree
+    0x20  position    int32 x2  latitude, longitude in 1e-5 degree
+    0x40  vrate       int16     ft/min
+    0x80  time        uint32    0.1 s since EPOCH, of the altitude
+
+Aircraft with non-ICAO addresses ("~" prefixed in SBS-1, like TIS-B) are
+not sent, their addresses don't fit the 24 bits.
+
+The bits 0x01-0x40 are the sbs1.F_* bits. The first record of an aircraft
+holds all its known fields, later ones only the changed fields plus the
+position, like the delta option of the other subprotocols. Clients keep
+the state per icao24 and merge records into it, see decode() and merge().
+"""
+
+from typing import *
+import struct
+
+VERSION = 1
+# 2024-01-01T00:00:00Z, time fields run until 2037
+EPOCH = 1704067200
+# the sbs1.F_* bits, repeated to keep this module free of server imports
+# for clients like client.py
+F_CALLSIGN = 0x01
+F_SQUAWK = 0x02
+F_ALTITUDE = 0x04
+F_SPEED = 0x08
+F_TRACK = 0x10
+F_POSITION = 0x20
+F_VRATE = 0x40
+F_TIME = 0x80
+ALL = 0xff
+
+# presence bit -> (struct format, number of values)
+FIELDS = [
+    (F_CALLSIGN, '8s', 1),
+    (F_SQUAWK, 'H', 1),
+    (F_ALTITUDE, 'h', 1),
+    (F_SPEED, 'H', 1),
+    (F_TRACK, 'H', 1),
+    (F_POSITION, 'ii', 2),
+    (F_VRATE, 'h', 1),
+    (F_TIME, 'I', 1),
+]
+
+# presence mask -> struct.Struct of the record
+_structs: Dict[int, struct.Struct] = {}
+
+
+def record_struct(mask: int) -> struct.Struct:
+    s = _structs.get(mask)
+    if s is None:
+        s = _structs[mask] = struct.Struct(
+            '<I' + ''.join(fmt for bit, fmt, _ in FIELDS if mask & bit))
+    return s
+
+
+def _clamp(v, lo, hi):
+    return lo if v < lo else hi if v > hi else v
+
+
+def encode(o, bits: int = ALL) -> bytes:
+    """The record of Observation o with the fields in bits, as far as known,
+    empty for non-ICAO addresses
+    """
+    t = o._table
+    row = o._row
+    if t.icao24[row] > 0xffffff:
+        return b""
+    mask = bits & int(t.present[row]) & 0x7f
+    if mask & F_ALTITUDE:
+        mask |= F_TIME
+    values = [int(t.icao24[row]) | mask << 24]
+    if mask & F_CALLSIGN:
+        values.append(t.callsign[row].ljust(8))
+    if mask & F_SQUAWK:
+        values.append(int(t.squawk[row]))
+    if mask & F_ALTITUDE:
+        values.append(_clamp(round(int(t.altitude[row]) / 25), -32768, 32767))
+    if mask & F_SPEED:
+        values.append(_clamp(round(float(t.groundSpeed[row]) * 10), 0, 65535))
+    if mask & F_TRACK:
+        values.append(round(float(t.track[row]) * 100) % 36000)
+    if mask & F_POSITION:
+        values.append(round(float(t.lat[row]) * 1e5))
+        values.append(round(float(t.lon[row]) * 1e5))
+    if mask & F_VRATE:
+        values.append(_clamp(int(t.verticalRate[row]), -32768, 32767))
+    if mask & F_TIME:
+        values.append(_clamp(round((float(t.altitudeTime[row]) + t.wallOffset - EPOCH) * 10),
+                             0, 0xffffffff))
+    return record_struct(mask).pack(*values)
+
+
+def frame(records: List[bytes]) -> bytes:
+    """The message of a tick's records"""
+    return bytes((VERSION,)) + b"".join(records)
+
+
+def decode(message: bytes) -> List[dict]:
+    """The records of a message as dicts with the property names of the
+    GeoJSON subprotocols, plus lat and lon
+    """
+    if not message or message[0] != VERSION:
+        raise ValueError(f"not an adsb-bin version {VERSION} message")
+    records = []
+    offset = 1
+    size = len(message)
+    while offset < size:
+        head, = struct.unpack_from('<I', message, offset)
+        mask = head >> 24
+        s = record_struct(mask)
+        values = s.unpack_from(message, offset)
+        offset += s.size
+        d = {"i": f"{head & 0xffffff:06X}"}
+        i = 1
+        for bit, _, n in FIELDS:
+            if not mask & bit:
+                continue
+            if bit == F_CALLSIGN:
+                d["c"] = values[i].decode('ascii', 'replace').rstrip()
+            elif bit == F_SQUAWK:
+                d["s"] = f"{values[i]:04d}"
+            elif bit == F_ALTITUDE:
+                d["a"] = values[i] * 25
+            elif bit == F_SPEED:
+                d["v"] = values[i] / 10
+            elif bit == F_TRACK:
+                d["h"] = values[i] / 100
+            elif bit == F_POSITION:
+                d["lat"] = values[i] / 1e5
+                d["lon"] = values[i + 1] / 1e5
+            elif bit == F_VRATE:
+                d["r"] = values[i]
+            elif bit == F_TIME:
+                d["t"] = values[i] / 10 + EPOCH
+            i += n
+        records.append(d)
+    return records
+
+
+def merge(state: Dict[str, dict], message: bytes) -> List[dict]:
+    """Merge a message into state, icao24 -> properties, returning the
+    merged properties of the aircraft it updated
+    """
+    updated = []
+    for d in decode(message):
+        aircraft = state.setdefault(d["i"], {})
+        aircraft.update(d)
+        updated.append(aircraft)
+    return updated
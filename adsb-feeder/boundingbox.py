@@ -1,15 +1,176 @@
 import jsonschema
 import json
+import math
 import sys
+import numpy as np
+
+import filters
+
+# meters, mean earth radius
+EARTH_RADIUS = 6371008.8
+
+
+class Circle(object):
+    """The area within radius meters of a center, by great circle distance
+
+    sin/cos of the center and the cosine of the angular radius are
+    precomputed, a test costs three trigonometric functions.
+    """
+
+    def __init__(self, lat: float, lon: float, radius: float):
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+        angle = min(radius / EARTH_RADIUS, math.pi)
+        self.angle = angle
+        self.sinLat = math.sin(math.radians(lat))
+        self.cosLat = math.cos(math.radians(lat))
+        self.cosAngle = math.cos(angle)
+
+    def extent(self):
+        """min_latitude, max_latitude, min_longitude, max_longitude"""
+        dlat = math.degrees(self.angle)
+        if self.lat + dlat >= 90 or self.lat - dlat <= -90 or \
+                math.sin(self.angle) >= self.cosLat:
+            # covers a pole
+            return max(self.lat - dlat, -90), min(self.lat + dlat, 90), -180, 180
+        dlon = math.degrees(math.asin(math.sin(self.angle) / self.cosLat))
+        return self.lat - dlat, self.lat + dlat, self.lon - dlon, self.lon + dlon
+
+    def contains(self, lat: float, lon: float) -> bool:
+        phi = math.radians(lat)
+        return (self.sinLat * math.sin(phi) +
+                self.cosLat * math.cos(phi) * math.cos(math.radians(lon - self.lon))
+                >= self.cosAngle)
+
+    def __repr__(self):
+        return f'Circle({self.lat}, {self.lon}, {self.radius})'
+
+
+class Polygon(object):
+    """Point in polygon test on a rasterized cell mask
+
+    The polygon's extent is divided into GRID x GRID cells, marked inside,
+    outside or boundary when the polygon is set. Only points in boundary
+    cells are tested exactly, by ray casting against the edges overlapping
+    their grid row.
+    """
+
+    GRID = 64
+    OUTSIDE = 0
+    INSIDE = 1
+    BOUNDARY = 2
+
+    def __init__(self, points: list):
+        """points is a ring of [longitude, latitude] pairs as in GeoJSON,
+        closed implicitly
+
+        Raises ValueError for rings with an edge longer than 180 degrees of
+        longitude, meant to cross the antimeridian the short way round,
+        which the longitude box prefilter can't represent.
+        """
+        lon = np.array([p[0] for p in points], dtype=np.float64)
+        lat = np.array([p[1] for p in points], dtype=np.float64)
+        if np.any(np.abs(np.roll(lon, -1) - lon) > 180):
+            raise ValueError("polygon crosses the antimeridian, which is not supported")
+        self.points = len(points)
+        self.min_latitude = float(lat.min())
+        self.max_latitude = float(lat.max())
+        self.min_longitude = float(lon.min())
+        self.max_longitude = float(lon.max())
+        grid = self.GRID
+        self.dlat = (self.max_latitude - self.min_latitude) / grid or 1e-9
+        self.dlon = (self.max_longitude - self.min_longitude) / grid or 1e-9
+
+        # edges from every point to the next
+        x0, y0 = lon, lat
+        x1, y1 = np.roll(lon, -1), np.roll(lat, -1)
+
+        cells = np.full((grid, grid), self.OUTSIDE, dtype=np.uint8)
+        r0 = self._rows(np.minimum(y0, y1))
+        r1 = self._rows(np.maximum(y0, y1))
+        c0 = self._columns(np.minimum(x0, x1))
+        c1 = self._columns(np.maximum(x0, x1))
+        # conservative: every cell an edge's extent overlaps
+        for a, b, c, d in zip(r0.tolist(), r1.tolist(), c0.tolist(), c1.tolist()):
+            cells[a:b + 1, c:d + 1] = self.BOUNDARY
+
+        # the other cells are entirely in or out, like their center
+        rows, columns = np.nonzero(cells != self.BOUNDARY)
+        clat = self.min_latitude + (rows + 0.5) * self.dlat
+        clon = self.min_longitude + (columns + 0.5) * self.dlon
+        inside = np.zeros(len(rows), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, len(rows), 256):
+                py = clat[start:start + 256, None]
+                px = clon[start:start + 256, None]
+                crosses = ((y0 > py) != (y1 > py)) & \
+                    (px < (x1 - x0) * (py - y0) / (y1 - y0) + x0)
+                inside[start:start + 256] = np.count_nonzero(crosses, axis=1) % 2 == 1
+        cells[rows[inside], columns[inside]] = self.INSIDE
+        # nested lists index faster than numpy for single points
+        self.cells = cells.tolist()
+
+        # per grid row the edges overlapping it
+        self.rowEdges = [[] for _ in range(grid)]
+        for edge, (a, b) in enumerate(zip(r0.tolist(), r1.tolist())):
+            e = (float(x0[edge]), float(y0[edge]), float(x1[edge]), float(y1[edge]))
+            for row in range(a, b + 1):
+                self.rowEdges[row].append(e)
+
+    def _rows(self, lat):
+        return np.clip(((lat - self.min_latitude) // self.dlat).astype(int), 0, self.GRID - 1)
+
+    def _columns(self, lon):
+        return np.clip(((lon - self.min_longitude) // self.dlon).astype(int), 0, self.GRID - 1)
+
+    def extent(self):
+        """min_latitude, max_latitude, min_longitude, max_longitude"""
+        return self.min_latitude, self.max_latitude, self.min_longitude, self.max_longitude
+
+    def contains(self, lat: float, lon: float) -> bool:
+        if (lat < self.min_latitude or lat > self.max_latitude or
+                lon < self.min_longitude or lon > self.max_longitude):
+            return False
+        row = min(int((lat - self.min_latitude) // self.dlat), self.GRID - 1)
+        column = min(int((lon - self.min_longitude) // self.dlon), self.GRID - 1)
+        state = self.cells[row][column]
+        if state != self.BOUNDARY:
+            return state == self.INSIDE
+        inside = False
+        for x0, y0, x1, y1 in self.rowEdges[row]:
+            if (y0 > lat) != (y1 > lat) and lon < (x1 - x0) * (lat - y0) / (y1 - y0) + x0:
+                inside = not inside
+        return inside
+
+    def __repr__(self):
+        return f'Polygon({self.points} points)'
 
 
 class BoundingBox(object):
     validKeys = ["min_latitude","max_latitude","min_longitude","max_longitude","min_altitude", "max_altitude"]
 
+    # client options which may accompany a bbox, like "delta"
+    validOptions = ["delta"]
+
+    # optional, like validKeys
+    optionalKeys = ["max_rate"]
+
     def __init__(self, source=None):
         """
         default to a match-all bbox
+
+        options stays None unless the source carried an options list,
+        max_rate (updates per second and aircraft) and filter (a compiled
+        filters.Filter) unless given.
+
+        shape is None, or the Polygon or Circle given, in which case the
+        box is narrowed to the shape's extent as a prefilter.
         """
+        self.options = None
+        self.max_rate = None
+        self.filter = None
+        self.shape = None
         self.min_latitude = -90
         self.max_latitude = 90
         self.min_longitude = -180
@@ -21,12 +182,20 @@ class BoundingBox(object):
 
     def fromDict(self, d):
         for k, v in d.items():
-            if k in self.validKeys:
+            if k in self.validKeys or k in self.optionalKeys:
                 setattr(self, k, float(v))
+        if "options" in d:
+            self.options = list(d["options"])
+        if "filter" in d:
+            self.filter = filters.compile(d["filter"])
+        if "polygon" in d:
+            self.setShape(Polygon(d["polygon"]))
+        elif "center" in d:
+            self.setShape(Circle(d["center"][1], d["center"][0], d["radius"]))
         #log.debug(f"new bbox = {repr(self)}")
 
     def fromParams(self, params):
-        for k in self.validKeys:
+        for k in self.validKeys + self.optionalKeys:
             if k in params:
                 try:
                     v = float(params[k][0])
@@ -35,15 +204,67 @@ class BoundingBox(object):
                 except Exception as e:
                     log.info(f"parsing param {k} from {params} :  {e}")
                     pass
+        try:
+            if "polygon" in params:
+                self.setShape(Polygon(self._shapeParam(params, "polygon", POLYGON_SCHEMA)))
+            elif "center" in params:
+                center = self._shapeParam(params, "center", POINT_SCHEMA)
+                self.setShape(Circle(center[1], center[0], float(params["radius"][0])))
+        except Exception as e:
+            log.info(f"parsing shape from {params} :  {e}")
+        if "filter" in params:
+            try:
+                spec = json.loads(params["filter"][0])
+                jsonschema.validate(spec, filters.SCHEMA)
+                self.filter = filters.compile(spec)
+            except Exception as e:
+                log.info(f"parsing param filter from {params} :  {e}")
         #log.debug(f"new bbox = {repr(self)}")
 
+    @staticmethod
+    def _shapeParam(params, k, schema):
+        v = json.loads(params[k][0])
+        jsonschema.validate(v, schema)
+        return v
+
+    def setShape(self, shape):
+        """Restrict to a Polygon or Circle, the box becomes its prefilter"""
+        self.shape = shape
+        min_lat, max_lat, min_lon, max_lon = shape.extent()
+        self.min_latitude = max(self.min_latitude, min_lat)
+        self.max_latitude = min(self.max_latitude, max_lat)
+        self.min_longitude = max(self.min_longitude, min_lon)
+        self.max_longitude = min(self.max_longitude, max_lon)
+
+    def area(self) -> float:
+        """Square degrees covered, 0 for an empty box"""
+        return (max(self.max_latitude - self.min_latitude, 0) *
+                max(self.max_longitude - self.min_longitude, 0))
+
     def __repr__(self):
         return (
             f'BoundingBox({self.min_latitude}, {self.max_latitude},'
             f' {self.min_longitude}, {self.max_longitude},'
-            f' {self.min_altitude}, {self.max_altitude})'
+            f' {self.min_altitude}, {self.max_altitude}'
+            f'{", " + repr(self.shape) if self.shape is not None else ""})'
         )
 
+
+# [longitude, latitude] as in GeoJSON
+POINT_SCHEMA = {
+    "type": "array",
+    "items": {"type": "number"},
+    "minItems": 2,
+    "maxItems": 2
+}
+
+POLYGON_SCHEMA = {
+    "type": "array",
+    "items": POINT_SCHEMA,
+    "minItems": 3,
+    "maxItems": 10000
+}
+
 class BBoxValidator(object):
     schema = {
         "type": "object",
@@ -73,12 +294,36 @@ class BBoxValidator(object):
             },
             "max_altitude": {
                 "type": "number"
+            },
+            "max_rate": {
+                "type": "number",
+                "minimum": 0
+            },
+            "options": {
+                "type": "array",
+                "items": {"enum": BoundingBox.validOptions}
+            },
+            "filter": filters.SCHEMA,
+            "polygon": POLYGON_SCHEMA,
+            "center": POINT_SCHEMA,
+            "radius": {
+                "type": "number",
+                "minimum": 0
             }
         },
-        "required": ["min_latitude", "min_longitude", "max_latitude", "max_longitude"],
+        # a box, or a polygon or circle with an optional box
+        "anyOf": [
+            {"required": ["min_latitude", "min_longitude", "max_latitude", "max_longitude"]},
+            {"required": ["polygon"]},
+            {"required": ["center", "radius"]}
+        ],
+        "dependencies": {
+            "center": ["radius"],
+            "radius": ["center"]
+        },
         "additionalProperties": {"type": "number"},
-        "minProperties": 4,
-        "maxProperties": 6
+        "minProperties": 1,
+        "maxProperties": 12
     }
 
     def __init__(self):
@@ -108,7 +353,13 @@ class BBoxValidator(object):
                 "result": -1,
                 "errors": [e.message for e in errors]
             })
-        bbox = BoundingBox(source=instance)
+        try:
+            bbox = BoundingBox(source=instance)
+        except ValueError as e:
+            return (False, None, {
+                "result": -1,
+                "errors": [str(e)]
+            })
         return (True, bbox, None)
 
 
@@ -0,0 +1,158 @@
+"""
+Per-client coalescing update queue
+
+client_updater hands every client's updates to its UpdateQueue, which
+keeps only the latest update per aircraft. While the transport accepts
+data the queue is handed to the client at the end of every tick. When the
+transport's buffer fills up it pauses the queue (IPushProducer), updates
+keep replacing each other in the queue, and delivery resumes with the
+latest state once the transport drained. A client paused for longer than
+STALL_TIMEOUT is disconnected.
+
+A delta update replacing a queued one, or one whose aircraft changed or
+expired meanwhile, is delivered as a full feature or dropped, so coalescing
+never loses properties.
+
+RateLimiter thins the updates of a client before they are queued, by an
+explicit max_rate or the area of its bounding box.
+"""
+
+from typing import *
+import time
+import math
+import numpy as np
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+# seconds a client may stay paused before it is disconnected
+STALL_TIMEOUT = 60
+
+# Without max_rate, boxes larger than THIN_AREA square degrees get at most
+# one update per aircraft every sqrt(area / THIN_AREA) seconds, up to
+# THIN_MAX: 1s for 20x20 degrees, 5s for the whole world.
+THIN_AREA = 400
+THIN_MAX = 5
+
+
+@implementer(IPushProducer)
+class UpdateQueue(object):
+
+    def __init__(self, client, stall_timeout=STALL_TIMEOUT):
+        """
+        client needs deliver(updates) taking a list of (encoding.Encoded,
+        delta) tuples, and stalled(), called once it stayed paused too long.
+        """
+        self.client = client
+        self.stall_timeout = stall_timeout
+        # icao24 -> [Encoded, delta, version]
+        self.updates: Dict[int, list] = {}
+        self.paused = None  # time.monotonic() when paused
+        self.stopped = False
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.updates)
+
+    def put(self, update, delta):
+        icao24 = update.icao24
+        if icao24 in self.updates:
+            self.coalesced += 1
+            delta = False
+        self.updates[icao24] = [update, delta, update.o.getVersion()]
+
+    def flush(self):
+        """Deliver the queued updates unless paused, call once per tick"""
+        if self.stopped or not self.updates:
+            return
+        if self.paused is not None:
+            if time.monotonic() - self.paused > self.stall_timeout:
+                self.stopped = True
+                self.updates = {}
+                self.client.stalled()
+            return
+        updates = []
+        for update, delta, version in self.updates.values():
+            if not update.current():
+                continue
+            if delta and update.o.getVersion() != version:
+                delta = False
+            updates.append((update, delta))
+        self.updates = {}
+        if updates:
+            self.client.deliver(updates)
+
+    def pauseProducing(self):
+        if self.paused is None:
+            self.paused = time.monotonic()
+
+    def resumeProducing(self):
+        self.paused = None
+        self.flush()
+
+    def stopProducing(self):
+        self.stopped = True
+        self.updates = {}
+
+    def stalledFor(self) -> float:
+        """Seconds paused, 0 if not"""
+        if self.paused is None:
+            return 0.
+        return time.monotonic() - self.paused
+
+
+class RateLimiter(object):
+    """Per-client minimum interval between updates of an aircraft
+
+    The times of the last update sent are kept in an array indexed by
+    AircraftTable row, along with the icao24 they were sent for, so an
+    aircraft taking over an expired one's row starts afresh. An update
+    arriving too early is deferred, replacing
+    an earlier deferred one, and sent in full once due, so the client ends
+    up with the latest state.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.sent = np.zeros(0)
+        self.sentIcao24 = np.full(0, -1, dtype=np.int64)
+        # icao24 -> encoding.Encoded
+        self.deferred: Dict[int, object] = {}
+
+    @classmethod
+    def forBBox(cls, bbox) -> "RateLimiter":
+        """The limiter for a bbox's max_rate, or its area if not given"""
+        if bbox.max_rate:
+            return cls(1. / bbox.max_rate)
+        if bbox.max_rate is None and bbox.area() > THIN_AREA:
+            return cls(min(math.sqrt(bbox.area() / THIN_AREA), THIN_MAX))
+        return cls(0.)
+
+    def due(self, row: int, icao24: int, now: float) -> bool:
+        """Whether an update of icao24 in row may be sent at now, recording it if so"""
+        if row >= len(self.sent):
+            size = max(row + 1, 2 * len(self.sent))
+            sent = np.zeros(size)
+            sent[:len(self.sent)] = self.sent
+            self.sent = sent
+            sentIcao24 = np.full(size, -1, dtype=np.int64)
+            sentIcao24[:len(self.sentIcao24)] = self.sentIcao24
+            self.sentIcao24 = sentIcao24
+        if self.sentIcao24[row] == icao24 and now - self.sent[row] < self.interval:
+            return False
+        self.sent[row] = now
+        self.sentIcao24[row] = icao24
+        return True
+
+    def defer(self, update):
+        self.deferred[update.icao24] = update
+
+    def takeDue(self, now: float) -> List[object]:
+        """The deferred updates which are due now"""
+        due = []
+        for icao24, update in list(self.deferred.items()):
+            if not update.current():
+                del self.deferred[icao24]
+            elif self.due(update.o.getRow(), icao24, now):
+                del self.deferred[icao24]
+                due.append(update)
+        return due
@@ -0,0 +1,224 @@
+"""
+Encode-once cache of aircraft features
+
+Every output (ZMQ PUB/DEALER, websocket and TCP clients, the reporter)
+asks EncodingCache for the format it needs. Each format of an aircraft is
+produced on first request and reused until the aircraft's version
+(AircraftTable.version, bumped on every change) moves on, so at most once
+per change however many subscribers want it, and never if nobody does.
+
+Delta formats hold the properties that were dirty when the version's
+entry was made, they are meant for client_updater, which asks before
+resetUpdated().
+
+Batch messages (FeatureCollections) are shared between the websocket
+clients receiving the same updates during a tick, see batch().
+"""
+
+from typing import *
+from collections import Counter
+import orjson
+import geobuf
+from autobahn.websocket.protocol import PreparedMessage
+
+import binproto
+from sbs1 import F_POSITION
+
+FEATURE = 'feature'             # __geo_interface__ dict
+JSON = 'json'
+GEOBUF = 'geobuf'
+DELTA = 'delta'                 # delta_interface() dict
+DELTA_JSON = 'delta-json'
+DELTA_GEOBUF = 'delta-geobuf'
+HTML_ROW = 'html-row'           # reporter table row
+BINARY = 'binary'               # binproto record
+DELTA_BINARY = 'delta-binary'
+# autobahn PreparedMessages, framed once for all websocket clients
+PREPARED_JSON = 'prepared-json'
+PREPARED_GEOBUF = 'prepared-geobuf'
+PREPARED_DELTA_JSON = 'prepared-delta-json'
+PREPARED_DELTA_GEOBUF = 'prepared-delta-geobuf'
+
+# as_dict() keys in the reporter's column order
+HTML_COLUMNS = ["icao24", "callsign", "squawk", "lat", "lon", "altitude",
+                "speed", "vspeed", "heading"]
+
+
+class EncodingCache(object):
+
+    def __init__(self):
+        # icao24 -> [version, dirty bits, {format: encoding}]
+        self.entries: Dict[int, list] = {}
+        # key -> PreparedMessage of the current tick
+        self.batches: Dict[tuple, PreparedMessage] = {}
+        self.stats = Counter(hits=0, encodes=0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry(self, icao24: int, o) -> list:
+        """The entry of o's current version, made with its dirty bits if new"""
+        version = o.getVersion()
+        entry = self.entries.get(icao24)
+        if entry is None or entry[0] != version:
+            entry = self.entries[icao24] = [version, o.getDirty(), {}]
+        return entry
+
+    def get(self, icao24: int, o, format: str):
+        """The encoding of Observation o in format"""
+        entry = self.entry(icao24, o)
+        encodings = entry[2]
+        value = encodings.get(format)
+        if value is None:
+            value = encodings[format] = self.encoders[format](self, icao24, o, entry[1])
+            self.stats['encodes'] += 1
+        else:
+            self.stats['hits'] += 1
+        return value
+
+    def newTick(self):
+        self.batches = {}
+
+    def batch(self, key: tuple, make: Callable[[], PreparedMessage]) -> PreparedMessage:
+        """The batch message for key, made by make() once per tick"""
+        message = self.batches.get(key)
+        if message is None:
+            message = self.batches[key] = make()
+            self.stats['batches'] += 1
+        else:
+            self.stats['batch hits'] += 1
+        return message
+
+    def prune(self, observations: Dict[int, object]):
+        """Drop the entries of aircraft no longer observed"""
+        for icao24 in self.entries.keys() - observations.keys():
+            del self.entries[icao24]
+
+    def _feature(self, icao24, o, dirty):
+        return o.__geo_interface__
+
+    def _json(self, icao24, o, dirty):
+        return orjson.dumps(self.get(icao24, o, FEATURE), option=orjson.OPT_APPEND_NEWLINE)
+
+    def _geobuf(self, icao24, o, dirty):
+        return geobuf.encode(self.get(icao24, o, FEATURE))
+
+    def _delta(self, icao24, o, dirty):
+        return o.delta_interface(dirty)
+
+    def _delta_json(self, icao24, o, dirty):
+        return orjson.dumps(self.get(icao24, o, DELTA), option=orjson.OPT_APPEND_NEWLINE)
+
+    def _delta_geobuf(self, icao24, o, dirty):
+        return geobuf.encode(self.get(icao24, o, DELTA))
+
+    def _html_row(self, icao24, o, dirty):
+        d = o.as_dict()
+        return "<tr>" + "".join(f'<td>{d[k]}</td>' for k in HTML_COLUMNS) + "</tr>"
+
+    def _binary(self, icao24, o, dirty):
+        return binproto.encode(o)
+
+    def _delta_binary(self, icao24, o, dirty):
+        return binproto.encode(o, dirty | F_POSITION)
+
+    def _prepared_json(self, icao24, o, dirty):
+        return PreparedMessage(self.get(icao24, o, JSON), False, False, False)
+
+    def _prepared_geobuf(self, icao24, o, dirty):
+        return PreparedMessage(self.get(icao24, o, GEOBUF), True, False, False)
+
+    def _prepared_delta_json(self, icao24, o, dirty):
+        return PreparedMessage(self.get(icao24, o, DELTA_JSON), False, False, False)
+
+    def _prepared_delta_geobuf(self, icao24, o, dirty):
+        return PreparedMessage(self.get(icao24, o, DELTA_GEOBUF), True, False, False)
+
+    encoders = {
+        FEATURE: _feature,
+        JSON: _json,
+        GEOBUF: _geobuf,
+        DELTA: _delta,
+        DELTA_JSON: _delta_json,
+        DELTA_GEOBUF: _delta_geobuf,
+        HTML_ROW: _html_row,
+        BINARY: _binary,
+        DELTA_BINARY: _delta_binary,
+        PREPARED_JSON: _prepared_json,
+        PREPARED_GEOBUF: _prepared_geobuf,
+        PREPARED_DELTA_JSON: _prepared_delta_json,
+        PREPARED_DELTA_GEOBUF: _prepared_delta_geobuf,
+    }
+
+
+def json_collection(features: List[bytes]) -> bytes:
+    """A FeatureCollection of JSON encoded features as made by
+    EncodingCache, without copying them through dicts again
+    """
+    return b'{"type":"FeatureCollection","features":[' + \
+        b",".join(f.rstrip(b"\n") for f in features) + b']}\n'
+
+
+def geobuf_collection(features: List[dict]) -> bytes:
+    return geobuf.encode({"type": "FeatureCollection", "features": features})
+
+
+class Encoded(object):
+    """One aircraft's encodings as sent to clients by client_updater"""
+
+    __slots__ = ('cache', 'icao24', 'o')
+
+    def __init__(self, cache: EncodingCache, icao24: int, o):
+        """Make before o.resetUpdated(), deltas need its dirty bits"""
+        self.cache = cache
+        self.icao24 = icao24
+        self.o = o
+        cache.entry(icao24, o)
+
+    def current(self) -> bool:
+        """False once the aircraft expired, its row may be reused"""
+        return self.o._table.observations.get(self.icao24) is self.o
+
+    def json(self, delta=False) -> bytes:
+        return self.cache.get(self.icao24, self.o, DELTA_JSON if delta else JSON)
+
+    def geobuf(self, delta=False) -> bytes:
+        return self.cache.get(self.icao24, self.o, DELTA_GEOBUF if delta else GEOBUF)
+
+    def feature(self, delta=False) -> dict:
+        return self.cache.get(self.icao24, self.o, DELTA if delta else FEATURE)
+
+    def binary(self, delta=False) -> bytes:
+        return self.cache.get(self.icao24, self.o, DELTA_BINARY if delta else BINARY)
+
+    def prepared(self, binary: bool, delta=False) -> PreparedMessage:
+        """The websocket message of the geobuf (binary) or JSON encoding"""
+        if binary:
+            format = PREPARED_DELTA_GEOBUF if delta else PREPARED_GEOBUF
+        else:
+            format = PREPARED_DELTA_JSON if delta else PREPARED_JSON
+        return self.cache.get(self.icao24, self.o, format)
+
+    def key(self, delta=False) -> tuple:
+        return (self.icao24, self.o.getVersion(), delta)
+
+
+def prepared_collection(updates: List[Tuple[Encoded, bool]], binary: bool) -> PreparedMessage:
+    """The FeatureCollection of updates as one websocket message, shared by
+    all clients receiving the same updates in a tick
+    """
+    cache = updates[0][0].cache
+    key = (binary,) + tuple(update.key(delta) for update, delta in updates)
+    if binary:
+        return cache.batch(key, lambda: PreparedMessage(
+            geobuf_collection([u.feature(d) for u, d in updates]), True, False, False))
+    return cache.batch(key, lambda: PreparedMessage(
+        json_collection([u.json(d) for u, d in updates]), False, False, False))
+
+
+def prepared_binary(updates: List[Tuple[Encoded, bool]]) -> PreparedMessage:
+    """The binproto message of updates, shared like prepared_collection()"""
+    cache = updates[0][0].cache
+    key = ('bin',) + tuple(update.key(delta) for update, delta in updates)
+    return cache.batch(key, lambda: PreparedMessage(
+        binproto.frame([u.binary(d) for u, d in updates]), True, False, False))
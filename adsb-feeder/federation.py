@@ -0,0 +1,89 @@
+"""
+Federated ingest from other adsb-feeder instances
+
+An instance may take the features another one publishes as upstream, to
+stack regional feeders under a hub:
+
+- --upstream-pub subscribes to the other's --pub-socket, on the adsb-json
+  topic as well as the tiled adsb-tile/ topics (see tiles), with
+  PubSubscriber
+- --upstream-json connects to the other's --downstream, which sends
+  newline separated JSON features, with main.JSONUpstreamProtocol
+
+The features are applied to the FlightObserver as the message dicts
+sbs1.parse_bytes() would return (FlightObserver.observeFeature()), so the
+text isn't rendered and parsed as SBS-1 again, and --merge and
+--priority work as for SBS-1 upstreams. Delta features apply like full
+ones, missing properties are left alone.
+"""
+
+from typing import *
+from collections import Counter
+import orjson
+import zmq
+
+import sbs1
+
+log = None
+
+TOPICS = [b'adsb-json', b'adsb-tile/']
+
+
+def feature_message(feature: dict) -> dict:
+    """The sbs1.parse_bytes() message of a feature as sent by client_updater"""
+    p = feature["properties"]
+    m = dict(sbs1.EMPTY_MSG)
+    m["icao24"] = p["i"]
+    m["callsign"] = p.get("c") or ""
+    m["squawk"] = p.get("s") or ""
+    m["altitude"] = p.get("a")
+    m["groundSpeed"] = p.get("v")
+    m["track"] = p.get("h")
+    m["verticalRate"] = p.get("r")
+    coordinates = (feature.get("geometry") or {}).get("coordinates")
+    if coordinates and coordinates[0] is not None and coordinates[1] is not None:
+        m["lon"] = coordinates[0]
+        m["lat"] = coordinates[1]
+        m["transmissionType"] = sbs1.ES_AIRBORNE_POS
+    elif m["groundSpeed"] is not None:
+        m["transmissionType"] = sbs1.ES_AIRBORNE_VEL
+    else:
+        m["transmissionType"] = sbs1.ES_IDENT_AND_CATEGORY
+    # features don't carry the generation time, merge by priority only
+    m["generatedTimestamp"] = None
+    return m
+
+
+class PubSubscriber(object):
+    """Subscriber to another instance's --pub-socket, a feed for merge"""
+
+    def __init__(self, flight_observer, address: str, priority=0, context=None):
+        self.observer = flight_observer
+        self.address = address
+        self.priority = priority
+        self.mergestats = Counter()
+        self.feedstats = Counter(messages=0, features=0, errors=0)
+        self.socket = (context or zmq.Context.instance()).socket(zmq.SUB)
+        self.socket.connect(address)
+        for topic in TOPICS:
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+
+    def receive(self):
+        """Apply all pending features, call periodically"""
+        observe = self.observer.observeFeature
+        while True:
+            try:
+                topic, *features = self.socket.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.feedstats['messages'] += 1
+            for feature in features:
+                try:
+                    observe(orjson.loads(feature), self)
+                    self.feedstats['features'] += 1
+                except (ValueError, KeyError, TypeError) as e:
+                    self.feedstats['errors'] += 1
+                    log.debug(f"bad feature from {self.address}: {e}")
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,119 @@
+"""
+Attribute filters sent along with a bounding box
+
+A bbox message may carry a "filter" object narrowing the aircraft sent
+to the client, all given conditions must hold:
+
+    "filter": {
+        "callsign": ["AUA", "OE"],        # callsign prefixes
+        "squawk": ["7500", "7600", "7700"],
+        "airborne": true,                 # false: on the ground only
+        "min_speed": 100,                 # ground speed in knots
+        "max_speed": 300
+    }
+
+A filter stays in place across later bbox messages without a "filter",
+like max_rate; "filter": {} removes it.
+
+An aircraft lacking a field a condition tests doesn't match. The table
+doesn't keep the SBS-1 on-ground flag, airborne means a ground speed of
+at least AIRBORNE_SPEED knots.
+
+compile() turns a filter into a Filter once, when the client sets it.
+Identical filters compile to the same Filter object, so client_updater
+evaluates each distinct filter once per aircraft however many clients
+share it.
+"""
+
+from typing import *
+import weakref
+import orjson
+
+from sbs1 import F_CALLSIGN, F_SQUAWK, F_SPEED
+
+# knots, slower aircraft count as on the ground
+AIRBORNE_SPEED = 50
+
+SCHEMA = {
+    "type": "object",
+    "description": "kept until replaced, {} matches every aircraft",
+    "properties": {
+        "callsign": {
+            "type": "array",
+            "items": {"type": "string", "minLength": 1, "maxLength": 8},
+            "maxItems": 100
+        },
+        "squawk": {
+            "type": "array",
+            "items": {"type": "string", "pattern": "^[0-7]{4}$"},
+            "maxItems": 100
+        },
+        "airborne": {"type": "boolean"},
+        "min_speed": {"type": "number", "minimum": 0},
+        "max_speed": {"type": "number", "minimum": 0}
+    },
+    "additionalProperties": False
+}
+
+# canonical filter -> Filter, while any client uses it
+_compiled = weakref.WeakValueDictionary()
+
+
+class Filter(object):
+    """Predicate on Observations compiled from a filter object"""
+
+    def __init__(self, key: bytes, tests: list):
+        self.key = key
+        self.tests = tests
+
+    def __call__(self, o) -> bool:
+        t = o._table
+        row = o._row
+        for test in self.tests:
+            if not test(t, row):
+                return False
+        return True
+
+    def __repr__(self):
+        return f"Filter({self.key.decode()})"
+
+
+def canonical(spec: dict) -> dict:
+    """spec with sorted, duplicate free lists, equal for equal filters"""
+    c = dict(spec)
+    if "callsign" in c:
+        c["callsign"] = sorted(set(p.upper() for p in c["callsign"]))
+    if "squawk" in c:
+        c["squawk"] = sorted(set(c["squawk"]))
+    return c
+
+
+def compile(spec: dict) -> Filter:
+    """The Filter of a filter object valid according to SCHEMA"""
+    spec = canonical(spec)
+    key = orjson.dumps(spec, option=orjson.OPT_SORT_KEYS)
+    f = _compiled.get(key)
+    if f is not None:
+        return f
+
+    tests = []
+    if "callsign" in spec:
+        prefixes = tuple(p.encode('ascii', 'replace') for p in spec["callsign"])
+        tests.append(lambda t, row: bool(t.present[row] & F_CALLSIGN) and
+                     t.callsign[row].startswith(prefixes))
+    if "squawk" in spec:
+        codes = frozenset(int(s) for s in spec["squawk"])
+        tests.append(lambda t, row: bool(t.present[row] & F_SQUAWK) and
+                     int(t.squawk[row]) in codes)
+    if "airborne" in spec:
+        airborne = spec["airborne"]
+        tests.append(lambda t, row: bool(t.present[row] & F_SPEED) and
+                     (t.groundSpeed[row] >= AIRBORNE_SPEED) == airborne)
+    if "min_speed" in spec or "max_speed" in spec:
+        lo = spec.get("min_speed", 0)
+        hi = spec.get("max_speed", float("inf"))
+        tests.append(lambda t, row: bool(t.present[row] & F_SPEED) and
+                     lo <= t.groundSpeed[row] <= hi)
+
+    f = _compiled[key] = Filter(key, tests)
+    return f
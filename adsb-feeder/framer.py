@@ -0,0 +1,69 @@
+"""
+Streaming line framer for upstream feeds
+
+TCP delivers arbitrary segments, so a line may be split across several
+dataReceived() calls. LineFramer splits each segment once, hands out the
+complete lines and carries the trailing partial line over in a bounded
+buffer until the rest of it arrives.
+"""
+
+from typing import *
+
+
+class LineFramer(object):
+
+    def __init__(self, max_length: int = 16384,
+                 lengthExceeded: Callable[[bytes], None] = None):
+        """
+        lengthExceeded is called with (a prefix of) every line longer than
+        max_length; such lines are dropped.
+        """
+        self.max_length = max_length
+        self.lengthExceeded = lengthExceeded
+        self._buffer = bytearray()
+        self._discarding = False
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Return the complete lines in data, without line terminators
+
+        A trailing '\\r' is left in place, the SBS-1 parsers ignore it.
+        """
+        lines = data.split(b'\n')
+        tail = lines.pop()
+
+        if self._discarding:
+            # rest of an overlong line
+            if not lines:
+                return lines
+            del lines[0]
+            self._discarding = False
+        elif self._buffer and lines:
+            self._buffer += lines[0]
+            lines[0] = bytes(self._buffer)
+            del self._buffer[:]
+
+        if tail and not self._discarding:
+            self._buffer += tail
+            if len(self._buffer) > self.max_length:
+                self._overflow(bytes(self._buffer))
+                del self._buffer[:]
+                self._discarding = True
+
+        if lines and max(map(len, lines)) > self.max_length:
+            for line in lines:
+                if len(line) > self.max_length:
+                    self._overflow(line)
+            lines = [l for l in lines if len(l) <= self.max_length]
+        return lines
+
+    def _overflow(self, line):
+        if self.lengthExceeded:
+            self.lengthExceeded(line)
+
+    def pending(self) -> int:
+        """Bytes of the partial line carried over"""
+        return len(self._buffer)
+
+    def reset(self):
+        del self._buffer[:]
+        self._discarding = False
@@ -42,9 +42,13 @@ from autobahn.twisted.websocket import WebSocketServerFactory, \
     WebSocketServerProtocol, \
     listenWS
 from autobahn.websocket.types import ConnectionDeny
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
 
 import sys
 import os
+import time
+import socket
+import multiprocessing
 import logging
 import logging.handlers as handlers
 import syslog
@@ -61,9 +65,20 @@ from collections import Counter
 import geojson
 import geobuf
 import zmq
+import numpy as np
 
 import observer
+import sbs1
 import boundingbox
+import framer
+import merge
+import shard
+import spatialindex
+import encoding
+import tiles
+import federation
+import metrics
+import clientqueue
 from jwt import InvalidAudienceError, ExpiredSignatureError, InvalidSignatureError, PyJWTError
 from jwtauth import *
 
@@ -74,6 +89,31 @@ facility = syslog.LOG_LOCAL1
 #pubSocket = "ipc:///tmp/adsb-json-feed"
 
 PING_EVERY = 30 # secs for now
+EXPIRE_EVERY = 1 # secs between aircraft expiry runs
+SNAPSHOT_EVERY = 10 # secs between state snapshots with --snapshot
+MIN_LATENCY = 0.1 # secs between client updates when idle
+MAX_LATENCY = 1.0 # secs between client updates under load
+UPDATE_LOAD = 0.25 # share of time client updates may take
+STATE_TOPIC = b'adsb-state' # PUB topic of table changes for --ws-workers
+WS_WORKER_RECEIVE_EVERY = 0.05 # secs between state receives in --ws-workers
+STATE_FULL_EVERY = 5 # secs between full state messages for --ws-workers
+FEDERATION_RECEIVE_EVERY = 0.05 # secs between receives from --upstream-pub
+LAG_EVERY = 0.5 # secs between reactor lag measurements
+
+PARSE_TIME = metrics.REGISTRY.histogram(
+    "adsb_parse_seconds_per_line", "upstream parse time per line", metrics.PARSE_BUCKETS)
+TICK_TIME = metrics.REGISTRY.histogram(
+    "adsb_update_tick_seconds", "client_updater run time", metrics.TICK_BUCKETS)
+REACTOR_LAG = metrics.REGISTRY.histogram(
+    "adsb_reactor_lag_seconds", "delay of a timed reactor call", metrics.LAG_BUCKETS)
+metrics.REGISTRY.describe("adsb_fanout_messages_total", "messages sent to clients and sockets")
+metrics.REGISTRY.describe("adsb_fanout_bytes_total", "payload bytes sent to clients and sockets")
+
+
+def count_fanout(protocol, messages, size):
+    metrics.REGISTRY.inc("adsb_fanout_messages_total", messages, protocol=protocol)
+    metrics.REGISTRY.inc("adsb_fanout_bytes_total", size, protocol=protocol)
+
 
 def within(lat, lon, alt, bbox):
     if lat < bbox.min_latitude:
@@ -88,34 +128,39 @@ def within(lat, lon, alt, bbox):
         return False
     if alt > bbox.max_altitude:
         return False
-    return True
+    return bbox.shape is None or bbox.shape.contains(lat, lon)
 
 
-class UpstreamProtocol(basic.LineOnlyReceiver):
+class UpstreamProtocol(Protocol):
 
     MAX_LENGTH = 16384
 
     def __init__(self, max_length_errors=5):
-        self.feedstats = Counter(bytes=0, lines=0)
+        self.feedstats = Counter(bytes=0, lines=0, errors=0)
+        self.mergestats = Counter()
+        self.priority = 0
         self.length_errors = 0
         self.max_length_errors = max_length_errors
+        self.framer = framer.LineFramer(self.MAX_LENGTH, self.lineLengthExceeded)
 
     def connectionMade(self):
         log.debug(f'[x] upstream connection established to'
                   f' {self.transport.getPeer()}')
         self.factory.upstreams.add(self)
         self.factory.countConnect(self.transport.getPeer().host)
+        self.priority = self.factory.priority
 
     def connectionLost(self, reason):
         log.debug(f'[ ] upstream connection to {self.transport.getPeer()}lost:'
                      f' {reason.value}')
         self.factory.upstreams.discard(self)
+        if self.factory.shards is not None:
+            self.factory.shards.close(self)
 
     def lineReceived(self, line):
         #log.debug(f'[x] line {line} received from upstream  {self.transport.getPeer()}')
         self.feedstats['lines'] += 1
-        self.feedstats['bytes'] += len(line)
-        self.factory.flight_observer.parse(line.decode())
+        self.factory.flight_observer.parse(line, self)
 
     def lineLengthExceeded(self, line):
         self.length_errors += 1
@@ -123,52 +168,82 @@ class UpstreamProtocol(basic.LineOnlyReceiver):
             log.error(f'[ ] line length {len(line)} exceeded too often ({self.length_errors}) {line[:10]}..{line[-10:]}, closing upstream {self.transport.getPeer()}')
             return self.transport.loseConnection()
 
-
     def dataReceived(self, data):
+        self.feedstats['bytes'] += len(data)
+        lines = self.framer.feed(data)
+        if self.transport.disconnecting:
+            return
+
+        if self.factory.shards is not None:
+            self.feedstats['lines'] += len(lines)
+            self.factory.shards.route(lines, self)
+            return
+
+        started = time.perf_counter()
+        if self.factory.batch:
+            self.feedstats['lines'] += self.factory.flight_observer.parseLines(lines, self)
+        else:
+            for line in lines:
+                if self.transport.disconnecting:
+                    # the transport may be told to lose the connection by a
+                    # line within a larger packet, disregard the rest of it
+                    break
+                self.lineReceived(line)
+        if lines:
+            PARSE_TIME.observe((time.perf_counter() - started) / len(lines), len(lines))
 
-        # this is buggy on buffer splits but a start
-        for line in  data.splitlines():
+class JSONUpstreamProtocol(UpstreamProtocol):
+    """Upstream reading another adsb-feeder's --downstream, see federation"""
+
+    # everything, unthinned
+    BBOX = orjson.dumps({"min_latitude": -90, "max_latitude": 90,
+                         "min_longitude": -180, "max_longitude": 180,
+                         "max_rate": 0})
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.transport.write(self.BBOX)
+
+    def lineReceived(self, line):
+        self.feedstats['lines'] += 1
+        try:
+            self.factory.flight_observer.observeFeature(orjson.loads(line), self)
+        except (ValueError, KeyError, TypeError) as e:
+            self.feedstats['errors'] += 1
+            log.debug(f'bad feature from {self.transport.getPeer()}: {e} {line[:80]}')
+
+    def dataReceived(self, data):
+        self.feedstats['bytes'] += len(data)
+        lines = self.framer.feed(data)
+        started = time.perf_counter()
+        for line in lines:
+            if self.transport.disconnecting:
+                break
             self.lineReceived(line)
+        if lines:
+            PARSE_TIME.observe((time.perf_counter() - started) / len(lines), len(lines))
 
-    # this needs fixing:
-    # def dataReceived(self, data):
-    #     """
-    #     Translates bytes into lines, and calls lineReceived.
-    #     split on universal newlines with splitlines()
-    #     """
-    #     b = self._buffer + data
-    #     lines = b.splitlines(False)
-    #     if ord(b[-1]) == 10:
-    #         # buffer ended in newline - complete
-    #         self._buffer = ''
-    #     else:
-    #         self._buffer = lines.pop(-1)
-    #     for line in lines:
-    #         if self.transport.disconnecting:
-    #             # this is necessary because the transport may be told to lose
-    #             # the connection by a line within a larger packet, and it is
-    #             # important to disregard all the lines in that packet following
-    #             # the one that told it to close.
-    #             return
-    #         if len(line) > self.MAX_LENGTH:
-    #             return self.lineLengthExceeded(line)
-    #         else:
-    #             self.lineReceived(line)
-    #     if len(self._buffer) > self.MAX_LENGTH:
-    #         return self.lineLengthExceeded(self._buffer)
 
 class UpstreamClientFactory(Factory):
 
     upstreams = set()
     connects = dict()
+    # shard.ShardRouter with --workers
+    shards = None
+    # federation.PubSubscriber per --upstream-pub
+    pubSubscribers = []
 
-    def __init__(self, protocol, flight_observer, permanent, parent, typus):
+    def __init__(self, protocol, flight_observer, permanent, parent, typus,
+                 batch=False, priority=0):
         self.protocol = protocol
         self.clients = set()
         self.flight_observer = flight_observer
         self.permanent = permanent
         self.parent = parent
         self.typus = typus
+        self.batch = batch
+        self.priority = priority
+        self.clientIndex = spatialindex.BBoxIndex()
 
     def countConnect(self, host):
         if not host in self.connects:
@@ -177,37 +252,61 @@ class UpstreamClientFactory(Factory):
 
     def registerClient(self, client):
         self.clients.add(client)
+        self.clientIndex.add(client)
         if not self.permanent and len(self.clients) == 1:
             self.parent.startService()
 
+    def updateClient(self, client):
+        """Call after client.bbox changed"""
+        if client in self.clients:
+            self.clientIndex.update(client)
+
     def unregisterClient(self, client):
         self.clients.discard(client)
+        self.clientIndex.remove(client)
         if not self.permanent and len(self.clients) == 0:
             self.parent.stopService()
 
 
-def client_updater(flight_observer, feeder_factory, pubSocket, dealerSocket):
+def client_updater(flight_observer, feeder_factory, pubSocket, dealerSocket,
+                   encoding_cache, state_publisher=None, tile_publisher=None):
 
     _topic = b'adsb-json'
 
+    if state_publisher is not None:
+        state_publisher.publish()
+
     if not feeder_factory.clients and not pubSocket and not dealerSocket:
+        if state_publisher is not None:
+            # published to the workers, nobody else to tell
+            for icao, o in flight_observer.getUpdated():
+                o.resetUpdated()
         return
 
-    # BATCH THIS!!
     obs = flight_observer.getObservations()
-
-    for icao, o in obs.items():
-        if not o.isUpdated():
-            continue
-        if not o.isPresentable():
-            continue
-
+    now = time.monotonic()
+    encoding_cache.newTick()
+    published = 0
+    publishedBytes = 0
+
+    for icao, o in flight_observer.getUpdated():
+        # filter -> verdict on o, shared by clients with identical filters
+        verdicts = {}
         lat = o.getLat()
         lon = o.getLon()
         alt = o.getAltitude()
 
-        js = orjson.dumps(o.__geo_interface__, option=orjson.OPT_APPEND_NEWLINE)
-        if pubSocket:
+        update = encoding.Encoded(encoding_cache, icao, o)
+        # a delta is relative to base, the version of the previous tick
+        base = o.getResetVersion()
+        version = o.getVersion()
+        if pubSocket or dealerSocket:
+            js = update.json()
+            published += 1
+            publishedBytes += len(js)
+        if tile_publisher is not None:
+            tile_publisher.add(lat, lon, alt, js)
+        elif pubSocket:
             pubSocket.send_multipart([_topic, js])
         if dealerSocket:
             try:
@@ -215,22 +314,268 @@ def client_updater(flight_observer, feeder_factory, pubSocket, dealerSocket):
             except zmq.error.Again:
                 pass
 
+        o.resetUpdated()
         if not feeder_factory.clients:
             continue
 
-        pbf = geobuf.encode(o.__geo_interface__)
-        for client in feeder_factory.clients:
+        for client in feeder_factory.clientIndex.candidates(lat, lon):
             if within(lat, lon, alt, client.bbox):
-                if isinstance(client, Downstream):
-                    client.transport.write(js)
-                if isinstance(client, WSServerProtocol):
-                    if not client.usr:
+                f = client.bbox.filter
+                if f is not None:
+                    passed = verdicts.get(f)
+                    if passed is None:
+                        passed = verdicts[f] = f(o)
+                    if not passed:
                         continue
-                    if client.proto == 'adsb-geobuf':
-                        client.sendMessage(pbf, True)
-                    if client.proto == 'adsb-json':
-                        client.sendMessage(js, False)
-        o.resetUpdated()
+                if client.limiter.interval and not client.limiter.due(o.getRow(), icao, now):
+                    client.limiter.defer(update)
+                    continue
+                # delta clients get the full feature unless they got the
+                # previous tick's state, the aircraft may have been out of
+                # their bbox, filtered or deferred meanwhile
+                send_delta = client.delta and client.known.get(icao) == base
+                if client.delta:
+                    client.known[icao] = version
+                client.sendUpdate(update, send_delta)
+
+    if tile_publisher is not None:
+        count_fanout("zmq-tiles", *tile_publisher.flush())
+    elif pubSocket and published:
+        count_fanout("zmq-pub", published, publishedBytes)
+    if dealerSocket and published:
+        count_fanout("zmq-dealer", published, publishedBytes)
+
+    for client in feeder_factory.clients:
+        if client.limiter.deferred:
+            for update in client.limiter.takeDue(now):
+                if client.delta:
+                    client.known[update.icao24] = update.o.getVersion()
+                client.sendUpdate(update, False)
+        client.flush()
+        # forget aircraft which expired meanwhile
+        if len(client.known) > 2 * len(obs) + 100:
+            client.known = {icao: version for icao, version in client.known.items()
+                            if icao in obs}
+    if len(encoding_cache) > 2 * len(obs) + 100:
+        encoding_cache.prune(obs)
+
+
+class StatePublisher(object):
+    """Publish table changes for --ws-workers on the PUB socket
+
+    Every tick the updated rows (AircraftTable.takeUpdated()) and the
+    aircraft removed since are sent as [STATE_TOPIC, orjson header, rows],
+    workers apply them to a mirror FlightObserver like shard updates.
+
+    Every full_every seconds all rows are sent instead, with "full" in the
+    header, so workers which joined late or lost messages to the PUB
+    socket's high water mark catch up and drop the aircraft missing.
+    """
+
+    def __init__(self, flight_observer, pubSocket, full_every=STATE_FULL_EVERY):
+        self.table = flight_observer.getTable()
+        self.table.removed = []
+        self.pubSocket = pubSocket
+        self.full_every = full_every
+        self.lastFull = time.monotonic()
+
+    def publish(self):
+        now = time.monotonic()
+        if now - self.lastFull >= self.full_every:
+            self.lastFull = now
+            self.table.removed = []
+            snap = self.table.snapshot(columns=self.table.snapshotColumns + ["dirty"])
+            self.pubSocket.send_multipart([STATE_TOPIC, orjson.dumps({"x": [], "full": True}),
+                                           snap.tobytes()])
+            return
+        snap = self.table.takeUpdated()
+        removed = self.table.removed
+        if not len(snap) and not removed:
+            return
+        self.table.removed = []
+        self.pubSocket.send_multipart([STATE_TOPIC, orjson.dumps({"x": removed}),
+                                       snap.tobytes()])
+
+
+def receive_state(subSocket, flight_observer):
+    """Apply StatePublisher messages to a mirror FlightObserver"""
+    while True:
+        try:
+            topic, header, rows = subSocket.recv_multipart(flags=zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        header = orjson.loads(header)
+        snap = np.frombuffer(rows, dtype=shard.snapshotType())
+        expired = header["x"]
+        if header.get("full"):
+            expired = list(flight_observer.getObservations().keys() -
+                           set(snap["icao24"].tolist()))
+        flight_observer.applyShard(snap, expired)
+
+
+def run_ws_worker(index, parent, url, pubSocket, options):
+    """Websocket worker process for --ws-workers
+
+    Serves websocket clients on url's port, shared with the other workers
+    by SO_REUSEPORT, from a mirror of the main process' state received
+    on pubSocket. options holds the parsed command line arguments needed.
+    """
+    name = f"{appName}-ws{index}"
+    setup_logging(options["logLevel"], name, options["logDir"])
+    observer.log = log
+    boundingbox.log = log
+    shard.log = log
+    setproctitle.setproctitle(f"{name} logdir={options['logDir']}")
+
+    flight_observer = observer.FlightObserver(expire_after=None,
+                                              trail_length=options["trailLength"],
+                                              trail_budget=options["trailBudget"])
+    # clients only, no upstreams
+    feeder_factory = UpstreamClientFactory(UpstreamProtocol, flight_observer, True,
+                                           None, "websocket worker")
+    websocket_factory = WSServerFactory(url)
+    websocket_factory.bbox_validator = boundingbox.BBoxValidator()
+    websocket_factory.jwt_auth = JWTAuthenticator(issuer="urn:mah.priv.at",
+                                                  audience=WSServerFactory._subprotocols,
+                                                  algorithm="HS256")
+    websocket_factory.deflate = options["wsDeflate"]
+    websocket_factory.feeder_factory = feeder_factory
+    websocket_factory.flight_observer = flight_observer
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # all interfaces like listenWS(), TLS is left to the nginx in front
+    sock.bind(('', websocket_factory.port))
+    sock.listen(128)
+    sock.setblocking(False)
+    reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, websocket_factory)
+    sock.close()
+
+    subSocket = zmq.Context().socket(zmq.SUB)
+    subSocket.connect(pubSocket)
+    subSocket.setsockopt(zmq.SUBSCRIBE, STATE_TOPIC)
+    LoopingCall(receive_state, subSocket, flight_observer).start(WS_WORKER_RECEIVE_EVERY)
+
+    encoding_cache = encoding.EncodingCache()
+    websocket_factory.encoding_cache = encoding_cache
+    UpdateScheduler(flight_observer.getTable(), feeder_factory.clients,
+                    options["minLatency"], options["maxLatency"],
+                    client_updater, flight_observer, feeder_factory, None, None,
+                    encoding_cache).start()
+
+    def checkParent():
+        if os.getppid() != parent and reactor.running:
+            log.info(f"{name}: parent gone, exiting")
+            reactor.stop()
+    LoopingCall(checkParent).start(1, now=False)
+
+    log.debug(f"{name} serving {url}")
+    reactor.run()
+
+
+class UpdateScheduler(object):
+    """Run client_updater as often as the load allows
+
+    A tick is skipped while the table has no changes and none of clients
+    holds deferred or queued updates, but not for longer than max_latency.
+    After a tick the next one is scheduled so that updating takes about
+    UPDATE_LOAD of the time, within min_latency and max_latency: an idle
+    server sends updates soon after they arrive, a busy one coalesces more
+    per tick.
+    """
+
+    def __init__(self, table, clients, min_latency, max_latency, update, *args):
+        self.table = table
+        self.clients = clients
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.update = update
+        self.args = args
+        self.interval = min_latency
+        self.changes = None
+        self.last = 0.
+        self.call = None
+
+    def pending(self) -> bool:
+        """Whether a client waits for deferred or queued updates"""
+        for client in self.clients:
+            if client.limiter.deferred or len(client.queue):
+                return True
+        return False
+
+    def start(self):
+        self.call = reactor.callLater(0, self.tick)
+
+    def stop(self):
+        if self.call and self.call.active():
+            self.call.cancel()
+
+    def tick(self):
+        try:
+            changes = self.table.changes
+            started = time.monotonic()
+            if (changes != self.changes or started - self.last >= self.max_latency or
+                    self.pending()):
+                self.changes = changes
+                self.last = started
+                self.update(*self.args)
+                took = time.monotonic() - started
+                TICK_TIME.observe(took)
+                self.interval = min(max(took / UPDATE_LOAD, self.min_latency),
+                                    self.max_latency)
+        except Exception:
+            log.exception("client update failed")
+        finally:
+            self.call = reactor.callLater(self.interval, self.tick)
+
+
+def save_snapshot(flight_observer, path):
+    try:
+        flight_observer.saveSnapshot(path)
+    except OSError as e:
+        log.error(f"failed to save snapshot {path}: {e}")
+
+
+def trail_request(flight_observer, payload):
+    """Answer a {"trail": "<icao24>"} request, None for other messages"""
+    try:
+        request = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(request, dict) or "trail" not in request:
+        return None
+    try:
+        icao24 = sbs1.icao24_key(request["trail"])
+    except (TypeError, ValueError):
+        return orjson.dumps({"status": "invalid icao24",
+                             "trail": request["trail"]},
+                            option=orjson.OPT_APPEND_NEWLINE)
+    trail = flight_observer.getTrail(icao24)
+    if trail is None:
+        return orjson.dumps({"status": "no trail", "trail": request["trail"]},
+                            option=orjson.OPT_APPEND_NEWLINE)
+    return orjson.dumps(trail, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def send_snapshot(client):
+    """Send a client all presentable aircraft within its bbox at once
+
+    Called when a client connects or changes its bbox, so it doesn't wait
+    for each aircraft's next change. The aircraft come from the observer's
+    grid index and go through the client's queue as full features, which
+    delta clients then know at their current version.
+    """
+    factory = client.factory
+    cache = factory.encoding_cache
+    f = client.bbox.filter
+    for icao, o in factory.flight_observer.getWithin(client.bbox):
+        if f is not None and not f(o):
+            continue
+        client.queue.put(encoding.Encoded(cache, icao, o), False)
+        if client.delta:
+            client.known[icao] = o.getVersion()
+    client.flush()
 
 
 class WSServerProtocol(WebSocketServerProtocol):
@@ -265,7 +610,13 @@ class WSServerProtocol(WebSocketServerProtocol):
 
         self.bbox = boundingbox.BoundingBox()
         self.bbox.fromParams(request.params)
+        self.limiter = clientqueue.RateLimiter.forBBox(self.bbox)
         self.geobuf = 'options' in request.params and 'geobuf' in request.params['options']
+        # send only changed properties after the first full feature
+        self.delta = 'options' in request.params and 'delta' in request.params['options']
+        # icao24 -> version last sent, for delta
+        self.known = {}
+        self.queue = clientqueue.UpdateQueue(self)
         self.forwarded_for = request.headers.get('x-forwarded-for', '')
         self.host = request.headers.get('host', '')
 
@@ -278,9 +629,15 @@ class WSServerProtocol(WebSocketServerProtocol):
 
         if not self.proto:
             raise ConnectionDeny(ConnectionDeny.BAD_REQUEST)
+        # adsb-bin records are always deltas
+        if self.proto == 'adsb-bin':
+            self.delta = True
 
         self.user_agent = request.headers.get('user-agent',"")
 
+        # autobahn negotiates compression after onConnect() chose proto
+        self.perMessageCompressionAccept = self.acceptDeflate
+
         log.debug(f"chosen protocol {self.proto} for {self.forwarded_for} via {self.peer} ua={self.user_agent}")
 
         if 'token' in request.params:
@@ -319,7 +676,9 @@ class WSServerProtocol(WebSocketServerProtocol):
     def onOpen(self):
         log.debug(f"connection open to {self.forwarded_for} via {self.peer}")
         self.run = True
+        self.transport.registerProducer(self.queue, True)
         self.factory.feeder_factory.registerClient(self)
+        send_snapshot(self)
         self.doPing()
 
 
@@ -329,6 +688,11 @@ class WSServerProtocol(WebSocketServerProtocol):
         # else:
         #     log.debug(f"Text message received: {payload.decode('utf8')}")
 
+        reply = trail_request(self.factory.flight_observer, payload)
+        if reply is not None:
+            self.sendMessage(reply, isBinary)
+            return
+
         (success, bbox, response) = self.factory.bbox_validator.validate_str(payload)
         if not success:
             log.info(f'{self.peer} bbox update failed: {response}')
@@ -336,7 +700,63 @@ class WSServerProtocol(WebSocketServerProtocol):
                 response, option=orjson.OPT_APPEND_NEWLINE), isBinary)
         else:
             log.debug(f'{self.peer} updated bbox: {bbox}')
+            # max_rate and filter stay until a bbox update replaces them
+            if bbox.max_rate is None:
+                bbox.max_rate = self.bbox.max_rate
+            if bbox.filter is None:
+                bbox.filter = self.bbox.filter
             self.bbox = bbox
+            self.limiter = clientqueue.RateLimiter.forBBox(bbox)
+            if bbox.options is not None and self.proto != 'adsb-bin':
+                self.delta = 'delta' in bbox.options
+            self.known.clear()
+            self.factory.feeder_factory.updateClient(self)
+            send_snapshot(self)
+
+    def sendUpdate(self, update, delta):
+        if not self.usr:
+            return
+        self.queue.put(update, delta)
+
+    def flush(self):
+        self.queue.flush()
+
+    def deliver(self, updates):
+        """Send updates from the queue, batch subprotocols as one
+        FeatureCollection
+
+        Messages are prepared once and shared with the other clients
+        getting the same, see encoding.
+        """
+        if self.proto == 'adsb-geobuf':
+            messages = [update.prepared(True, delta) for update, delta in updates]
+        elif self.proto == 'adsb-json':
+            messages = [update.prepared(False, delta) for update, delta in updates]
+        elif self.proto == 'adsb-geobuf-batch':
+            messages = [encoding.prepared_collection(updates, True)]
+        elif self.proto == 'adsb-json-batch':
+            messages = [encoding.prepared_collection(updates, False)]
+        elif self.proto == 'adsb-bin':
+            messages = [encoding.prepared_binary(updates)]
+        for message in messages:
+            self.sendPreparedMessage(message)
+        count_fanout(self.proto, len(messages), sum(len(m.payload) for m in messages))
+
+    def acceptDeflate(self, offers):
+        """permessage-deflate for the batch subprotocols and adsb-bin with
+        --ws-deflate
+        """
+        if not self.factory.deflate or not (self.proto.endswith('-batch') or
+                                            self.proto == 'adsb-bin'):
+            return None
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                return PerMessageDeflateOfferAccept(offer)
+        return None
+
+    def stalled(self):
+        log.info(f"{self.forwarded_for} via {self.peer} stalled for {self.queue.stall_timeout}s, dropping")
+        self.dropConnection(abort=True)
 
     def onClose(self, wasClean, code, reason):
         log.debug(
@@ -348,18 +768,29 @@ class WSServerProtocol(WebSocketServerProtocol):
 class WSServerFactory(WebSocketServerFactory):
 
     protocol = WSServerProtocol
-    _subprotocols = ['adsb-geobuf', 'adsb-json']
+    # the batch variants send one FeatureCollection per update tick, they
+    # are preferred when offered, adsb-bin (see binproto) before all
+    _subprotocols = ['adsb-bin', 'adsb-geobuf-batch', 'adsb-json-batch', 'adsb-geobuf', 'adsb-json']
+    # accept permessage-deflate for batch subprotocols
+    deflate = False
 
 
 class Downstream(Protocol):
 
     def __init__(self):
         self.bbox = boundingbox.BoundingBox()
+        self.limiter = clientqueue.RateLimiter.forBBox(self.bbox)
+        self.delta = False
+        # icao24 -> version last sent, for delta
+        self.known = {}
+        self.queue = clientqueue.UpdateQueue(self)
 
     def connectionMade(self):
         log.debug(
             f'[x] downstream connection established from {self.transport.getPeer()}')
+        self.transport.registerProducer(self.queue, True)
         self.factory.feeder_factory.registerClient(self)
+        send_snapshot(self)
 
     def connectionLost(self, reason):
         log.debug(
@@ -369,12 +800,42 @@ class Downstream(Protocol):
     def dataReceived(self, data):
         log.debug(
             f'==> received {data} from downstream  {self.transport.getPeer()}')
+        reply = trail_request(self.factory.flight_observer, data)
+        if reply is not None:
+            self.transport.write(reply)
+            return
         (success, bbox, response) = self.factory.bbox_validator.validate_str(data)
         if not success:
-            self.transport.write(json.dumps(response).encode("utf8"))
+            self.transport.write(orjson.dumps(response, option=orjson.OPT_APPEND_NEWLINE))
         else:
             log.debug(f'{self.transport.getPeer()} updated bbox: {bbox}')
+            # max_rate and filter stay until a bbox update replaces them
+            if bbox.max_rate is None:
+                bbox.max_rate = self.bbox.max_rate
+            if bbox.filter is None:
+                bbox.filter = self.bbox.filter
             self.bbox = bbox
+            self.limiter = clientqueue.RateLimiter.forBBox(bbox)
+            if bbox.options is not None:
+                self.delta = 'delta' in bbox.options
+            self.known.clear()
+            self.factory.feeder_factory.updateClient(self)
+            send_snapshot(self)
+
+    def sendUpdate(self, update, delta):
+        self.queue.put(update, delta)
+
+    def flush(self):
+        self.queue.flush()
+
+    def deliver(self, updates):
+        lines = [update.json(delta) for update, delta in updates]
+        self.transport.writeSequence(lines)
+        count_fanout("tcp", len(lines), sum(map(len, lines)))
+
+    def stalled(self):
+        log.info(f"downstream {self.transport.getPeer()} stalled for {self.queue.stall_timeout}s, dropping")
+        self.transport.abortConnection()
 
 
 class DownstreamFactory(Factory):
@@ -411,11 +872,121 @@ def setup_logging(level, appName, logDir):
     logHandler.setLevel(level)
     log.addHandler(logHandler)
 
+class ReactorLag(object):
+    """Records how late a LoopingCall every interval seconds runs"""
+
+    def __init__(self, interval=LAG_EVERY):
+        self.interval = interval
+        self.last = None
+
+    def check(self):
+        now = time.monotonic()
+        if self.last is not None:
+            REACTOR_LAG.observe(max(now - self.last - self.interval, 0.))
+        self.last = now
+
+    def start(self):
+        LoopingCall(self.check).start(self.interval)
+
+
+def state_metrics(flight_observer, feeder_factory, encoding_cache):
+    """metrics collector of the state read when scraped"""
+    Sample = metrics.Sample
+    yield Sample("adsb_aircraft", metrics.GAUGE, "aircraft observed", {},
+                 len(flight_observer.getObservations()))
+    totals, byType = flight_observer.getTotals()
+    for k, help in (("messages", "upstream messages"),
+                    ("observations", "upstream observations"),
+                    ("errors", "upstream MSG lines which failed to parse"),
+                    ("ignored", "upstream lines other than MSG records, like STA or blank")):
+        yield Sample(f"adsb_{k}_total", metrics.COUNTER, help, {}, totals.get(k, 0))
+    for t, n in byType.items():
+        yield Sample("adsb_messages_by_type_total", metrics.COUNTER,
+                     "upstream messages by transmission type",
+                     {"type": str(t)}, n)
+
+    for u in feeder_factory.upstreams:
+        labels = {"feed": str(u.transport.getPeer()), "typus": u.factory.typus}
+        for k in ("lines", "bytes", "errors"):
+            yield Sample(f"adsb_upstream_{k}_total", metrics.COUNTER,
+                         f"upstream {k} per connection", labels, u.feedstats[k])
+        for verdict, n in u.mergestats.items():
+            yield Sample("adsb_upstream_merge_total", metrics.COUNTER,
+                         "merge verdicts per upstream connection",
+                         dict(labels, verdict=verdict), n)
+    for u in feeder_factory.pubSubscribers:
+        labels = {"feed": u.address, "typus": "pub subscriber"}
+        yield Sample("adsb_upstream_lines_total", metrics.COUNTER,
+                     "upstream lines per connection", labels, u.feedstats['features'])
+        yield Sample("adsb_upstream_errors_total", metrics.COUNTER,
+                     "upstream errors per connection", labels, u.feedstats['errors'])
+    for host, connects in feeder_factory.connects.items():
+        yield Sample("adsb_upstream_connects_total", metrics.COUNTER,
+                     "upstream (re)connects per host", {"host": host}, connects['connects'])
+    if feeder_factory.shards is not None:
+        yield Sample("adsb_shard_dropped_lines_total", metrics.COUNTER,
+                     "lines dropped as a shard worker's queue was full", {},
+                     feeder_factory.shards.dropped)
+
+    depth = metrics.Histogram("adsb_client_queue_depth",
+                              "updates queued per client", metrics.QUEUE_BUCKETS)
+    kinds = Counter()
+    stalled = 0
+    for client in feeder_factory.clients:
+        kinds[client.proto if isinstance(client, WSServerProtocol) else "tcp"] += 1
+        depth.observe(len(client.queue))
+        if client.queue.paused is not None:
+            stalled += 1
+    for kind, n in kinds.items():
+        yield Sample("adsb_clients", metrics.GAUGE, "connected clients by protocol",
+                     {"protocol": kind}, n)
+    yield Sample("adsb_clients_paused", metrics.GAUGE,
+                 "clients whose transport is not accepting data", {}, stalled)
+    yield depth
+
+    for k, n in encoding_cache.stats.items():
+        yield Sample("adsb_encoding_cache_total", metrics.COUNTER,
+                     "encoding cache hits, encodes and batches", {"kind": k}, n)
+
+
+class MetricsResource(Resource):
+    """Prometheus metrics, JSON with ?format=json"""
+    isLeaf = True
+
+    def render_GET(self, request):
+        if request.args.get(b"format", [b""])[0] == b"json":
+            request.setHeader(b"content-type", b"application/json")
+            return metrics.REGISTRY.json()
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")
+        return metrics.REGISTRY.prometheus()
+
+
+class TrailResource(Resource):
+    isLeaf = True
+
+    def __init__(self, flight_observer):
+        self.observer = flight_observer
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"application/json")
+        try:
+            icao24 = sbs1.icao24_key(request.args.get(b"icao24", [b""])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return orjson.dumps({"status": "invalid icao24"})
+        trail = self.observer.getTrail(icao24)
+        if trail is None:
+            request.setResponseCode(404)
+            return orjson.dumps({"status": "no trail"})
+        return orjson.dumps(trail)
+
+
 class StateResource(Resource):
 
     def __init__(self, flight_observer, feeder_factory,
-                 downstream_factory, websocket_factory):
+                 downstream_factory, websocket_factory, encoding_cache):
         self.observer = flight_observer
+        self.encoding_cache = encoding_cache
         self.feeder_factory = feeder_factory
         self.downstream_factory = downstream_factory
         self.websocket_factory = websocket_factory
@@ -437,16 +1008,35 @@ class StateResource(Resource):
     <th>msgs received</th>
     <th>total byes</th>
     <th>typus</th>
+    <th>priority</th>
+    <th>duplicates</th>
+    <th>stale</th>
+    <th>superseded</th>
 </tr>"""
         for u in self.feeder_factory.upstreams:
             upstreams += (
-
-#FIXME          self.feeder_factory.connects[host]['connects'] += 1
                 f"<tr><td>{u.transport.getPeer()}</td>"
-                f"<td>{u.feedstats['connects']}</td>"
+                f"<td>{u.factory.connects.get(u.transport.getPeer().host, Counter())['connects']}</td>"
                 f"<td>{u.feedstats['lines']}</td>"
                 f"<td>{u.feedstats['bytes']}</td>"
                 f"<td>{u.factory.typus}</td>"
+                f"<td>{u.priority}</td>"
+                f"<td>{u.mergestats[merge.DUPLICATE]}</td>"
+                f"<td>{u.mergestats[merge.STALE]}</td>"
+                f"<td>{u.mergestats[merge.SUPERSEDED]}</td>"
+                f"</tr>\n"
+            )
+        for u in self.feeder_factory.pubSubscribers:
+            upstreams += (
+                f"<tr><td>{u.address}</td>"
+                f"<td></td>"
+                f"<td>{u.feedstats['features']}</td>"
+                f"<td></td>"
+                f"<td>pub subscriber</td>"
+                f"<td>{u.priority}</td>"
+                f"<td>{u.mergestats[merge.DUPLICATE]}</td>"
+                f"<td>{u.mergestats[merge.STALE]}</td>"
+                f"<td>{u.mergestats[merge.SUPERSEDED]}</td>"
                 f"</tr>\n"
             )
         upstreams += "</table>"
@@ -456,7 +1046,12 @@ class StateResource(Resource):
 
         for client in self.feeder_factory.clients:
             if isinstance(client, Downstream):
-                tcp_clients += f"\t\t<tr><td>{client.transport.getPeer()}</td><td>{client.bbox}</td></tr>\n"
+                tcp_clients += (
+                    f"\t\t<tr><td>{client.transport.getPeer()}</td>"
+                    f"<td>{client.bbox}</td>"
+                    f"<td>queued {len(client.queue)}, coalesced {client.queue.coalesced}, "
+                    f"stalled {client.queue.stalledFor():.1f} s</td></tr>\n"
+                )
 
             if isinstance(client, WSServerProtocol):
                 ws_clients += (
@@ -464,8 +1059,10 @@ class StateResource(Resource):
                     f"<td>{client.bbox}</td>"
                     f"<td>{client.usr}</td>"
                     f"<td>{client.forwarded_for}</td>"
-                    f"<td>{client.user_agent}</td></tr>\n"
-                    f"<td>{self.now - client.last_heard:.1f} s ago</td></tr>\n"
+                    f"<td>{client.user_agent}</td>"
+                    f"<td>{self.now - client.last_heard:.1f} s ago</td>"
+                    f"<td>queued {len(client.queue)}, coalesced {client.queue.coalesced}, "
+                    f"stalled {client.queue.stalledFor():.1f} s</td>"
                     f"</tr>\n"
                 )
         aircraft = """
@@ -486,11 +1083,7 @@ class StateResource(Resource):
             #log.debug(f'icao={icao} o={o}')
             if not o.isPresentable():
                 continue
-            d = o.as_dict()
-            aircraft += "<tr>"
-            for k in ["icao24", "callsign", "squawk", "lat", "lon", "altitude", "speed", "vspeed", "heading"]:
-                aircraft += f'<td>{d[k]}</td>'
-            aircraft += "</tr>"
+            aircraft += self.encoding_cache.get(icao, o, encoding.HTML_ROW)
         aircraft += "</table>"
 
         response = f"""\
@@ -558,6 +1151,22 @@ def main():
                         type=str,
                         help='upstream listen definition like tcp:30003:interface=192.168.1.1')
 
+    parser.add_argument('--upstream-pub',
+                        dest='upstreamPubs',
+                        action='append',
+                        type=str,
+                        default=[],
+                        help="another adsb-feeder's --pub-socket to take aircraft from, "
+                        "like tcp://10.0.0.2:5001")
+
+    parser.add_argument('--upstream-json',
+                        dest='upstreamJSONs',
+                        action='append',
+                        type=str,
+                        default=[],
+                        help="another adsb-feeder's --downstream to take aircraft from, "
+                        "outgoing connect definition like tcp:10.0.0.2:1079")
+
     parser.add_argument('--downstream',
                         dest='downstream',
                         action='store',
@@ -572,6 +1181,18 @@ def main():
                         default=None,
                         help='websocket listen definition like ws://127.0.0.1:1080')
 
+    parser.add_argument('--ws-workers',
+                        dest='wsWorkers',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='serve --websocket from this many worker processes sharing the port, '
+                        'fed by --pub-socket (default ipc:///tmp/adsb-feeder-pub-<pid>)')
+
+    parser.add_argument("--ws-deflate", type=str2bool, nargs='?',
+                        const=True, default=False, dest="wsDeflate",
+                        help="accept permessage-deflate for the batch websocket subprotocols and adsb-bin")
+
     parser.add_argument('--reporter',
                         dest='reporter',
                         action='store',
@@ -583,6 +1204,86 @@ def main():
                         const=True, default=False,
                         help="always keep feeder connections open.")
 
+    parser.add_argument("--batch", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="parse upstream data in columnar batches per TCP chunk instead of line by line.")
+
+    parser.add_argument("--merge", type=str2bool, nargs='?',
+                        const=True, default=False,
+                        help="drop duplicate, out-of-order and lower priority upstream messages.")
+
+    parser.add_argument('--priority',
+                        dest='priorities',
+                        action='append',
+                        type=str,
+                        default=[],
+                        help='upstream priority for --merge like tcp:1.2.3.4:30003=10, '
+                        'the key being an --upstream, --upstream-server, --upstream-pub '
+                        'or --upstream-json definition, default 0')
+
+    parser.add_argument('--expire-after',
+                        dest='expireAfter',
+                        action='store',
+                        type=float,
+                        default=observer.OBSERVATION_EXPIRE_AFTER,
+                        help='forget aircraft not heard from for this many seconds')
+
+    parser.add_argument('--trail-length',
+                        dest='trailLength',
+                        action='store',
+                        type=int,
+                        default=observer.TRAIL_LENGTH,
+                        help='positions kept per aircraft trail')
+
+    parser.add_argument('--trail-budget',
+                        dest='trailBudget',
+                        action='store',
+                        type=int,
+                        default=observer.TRAIL_BUDGET,
+                        help='positions kept for all trails together, 0 disables trails')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='parse and observe in this many worker processes, sharded by icao24')
+
+    parser.add_argument('--shard-socket',
+                        dest='shardSocket',
+                        action='store',
+                        default=None,
+                        type=str,
+                        help='socket prefix for talking to --workers, default ipc:///tmp/adsb-feeder-shard-<pid>')
+
+    parser.add_argument('--min-latency',
+                        dest='minLatency',
+                        action='store',
+                        type=float,
+                        default=MIN_LATENCY,
+                        help='seconds between client updates when idle')
+
+    parser.add_argument('--max-latency',
+                        dest='maxLatency',
+                        action='store',
+                        type=float,
+                        default=MAX_LATENCY,
+                        help='seconds between client updates at most, updates are coalesced more under load')
+
+    parser.add_argument('--snapshot',
+                        dest='snapshot',
+                        action='store',
+                        default=None,
+                        type=str,
+                        help='file to save the aircraft state to periodically and restore it from on startup, like /var/tmp/adsb-feeder.npy')
+
+    parser.add_argument('--snapshot-interval',
+                        dest='snapshotInterval',
+                        action='store',
+                        type=float,
+                        default=SNAPSHOT_EVERY,
+                        help='seconds between snapshots')
+
     parser.add_argument('-l', '--log',
                         help="set the logging level. Arguments:  DEBUG, INFO, WARNING, ERROR, CRITICAL",
                         choices=['DEBUG', 'INFO',
@@ -617,8 +1318,19 @@ def main():
                         type=str,
                         help='DEALER socket like ipc:///tmp/adsb-json-feed-push or tcp://127.0.0.1:5001')
 
+    parser.add_argument('--pub-tiles',
+                        dest='pubTiles',
+                        action='store',
+                        default=0,
+                        type=int,
+                        help='publish on adsb-tile/<altitude band>/<geohash> topics with geohashes '
+                        'of this precision, one multipart message per tile and update tick, '
+                        'instead of adsb-json (default 0, off)')
+
 
     args = parser.parse_args()
+    if args.workers and (args.upstreamPubs or args.upstreamJSONs):
+        parser.error("--upstream-pub and --upstream-json don't work with --workers")
 
     level = logging.WARNING
     if args.logLevel:
@@ -630,6 +1342,8 @@ def main():
     observer.trace_parser = args.debugParser
     observer.log = log
     boundingbox.log = log
+    shard.log = log
+    federation.log = log
     jwt_authenticator = JWTAuthenticator(issuer="urn:mah.priv.at",
                                          audience=WSServerFactory._subprotocols,
                                          algorithm="HS256")
@@ -643,6 +1357,7 @@ def main():
         websocket_factory = WSServerFactory(args.websocket)
         websocket_factory.bbox_validator = bbox_validator
         websocket_factory.jwt_auth = jwt_authenticator
+        websocket_factory.deflate = args.wsDeflate
 
 
     downstream_factory = None
@@ -651,32 +1366,89 @@ def main():
         downstream_factory.bbox_validator = bbox_validator
         downstream_server = serverFromString(reactor, args.downstream)
 
-    flight_observer = observer.FlightObserver()
+    priorities = dict()
+    for p in args.priorities:
+        dest, _, prio = p.rpartition('=')
+        priorities[dest] = int(prio)
+
+    merger = None
+    if args.merge or priorities:
+        merger = merge.FeedMerger()
+    if args.workers > 0:
+        # mirror of the workers' state, they expire aircraft
+        flight_observer = observer.FlightObserver(expire_after=None,
+                                                  trail_length=args.trailLength,
+                                                  trail_budget=args.trailBudget)
+        shardSocket = args.shardSocket or f"ipc:///tmp/{appName}-shard-{os.getpid()}"
+        UpstreamClientFactory.shards = shard.ShardRouter(
+            flight_observer, args.workers, shardSocket,
+            dict(expire_after=args.expireAfter, merge_feeds=merger is not None,
+                 batch=args.batch, snapshot=args.snapshot,
+                 setup_logging=setup_logging, appName=appName,
+                 logLevel=level, logDir=args.logDir),
+            parse_time=PARSE_TIME)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      UpstreamClientFactory.shards.stop)
+        LoopingCall(UpstreamClientFactory.shards.receive).start(shard.TICK)
+    else:
+        flight_observer = observer.FlightObserver(expire_after=args.expireAfter,
+                                                  merger=merger,
+                                                  trail_length=args.trailLength,
+                                                  trail_budget=args.trailBudget)
+        if args.snapshot:
+            try:
+                restored = flight_observer.loadSnapshot(args.snapshot)
+                log.info(f"restored {restored} aircraft from {args.snapshot}")
+            except Exception as e:
+                log.error(f"failed to load snapshot {args.snapshot}: {e}")
+
+    encoding_cache = encoding.EncodingCache()
 
     retryPolicy = backoffPolicy(initialDelay=120, factor=2, maxDelay=600)
 
     upstream_server_factory = None
     if args.upstreamServer:
-        upstream_server_factory = UpstreamClientFactory(UpstreamProtocol, flight_observer, True, feeders, "listener")
+        upstream_server_factory = UpstreamClientFactory(UpstreamProtocol, flight_observer, True, feeders, "listener", args.batch,
+                                                        priorities.get(args.upstreamServer, 0))
         upstream_server_endpoint = serverFromString(reactor, args.upstreamServer)
         feeder_server = StreamServerEndpointService(upstream_server_endpoint, upstream_server_factory)
         feeder_server.setServiceParent(feeders)
 
-    feeder_factory = UpstreamClientFactory(UpstreamProtocol, flight_observer, args.permanent, feeders, "outbound connector")
+    feeder_factory = UpstreamClientFactory(UpstreamProtocol, flight_observer, args.permanent, feeders, "outbound connector", args.batch)
     for dest in args.upstreams:
         feeder_endpoint = clientFromString(reactor, dest)
-        feeder = ClientService(feeder_endpoint, feeder_factory, retryPolicy=retryPolicy)
+        # one factory per upstream to carry its priority, downstream
+        # clients register with feeder_factory
+        upstream_factory = UpstreamClientFactory(UpstreamProtocol, flight_observer, args.permanent, feeders,
+                                                 "outbound connector", args.batch, priorities.get(dest, 0))
+        feeder = ClientService(feeder_endpoint, upstream_factory, retryPolicy=retryPolicy)
+        feeder.setServiceParent(feeders)
+    for dest in args.upstreamJSONs:
+        upstream_factory = UpstreamClientFactory(JSONUpstreamProtocol, flight_observer, args.permanent,
+                                                 feeders, "adsb-feeder downstream",
+                                                 priority=priorities.get(dest, 0))
+        feeder = ClientService(clientFromString(reactor, dest), upstream_factory,
+                               retryPolicy=retryPolicy)
         feeder.setServiceParent(feeders)
+    for address in args.upstreamPubs:
+        subscriber = federation.PubSubscriber(flight_observer, address,
+                                              priorities.get(address, 0))
+        UpstreamClientFactory.pubSubscribers.append(subscriber)
+        LoopingCall(subscriber.receive).start(FEDERATION_RECEIVE_EVERY)
 
     if args.downstream:
         downstream_factory.feeders = feeders
         downstream_factory.feeder_factory = feeder_factory
+        downstream_factory.flight_observer = flight_observer
+        downstream_factory.encoding_cache = encoding_cache
         downstream_server.listen(downstream_factory)
 
 #    if args.upstreamServer:
 
-    if args.websocket:
+    if args.websocket and not args.wsWorkers:
         websocket_factory.feeder_factory = feeder_factory
+        websocket_factory.flight_observer = flight_observer
+        websocket_factory.encoding_cache = encoding_cache
         listenWS(websocket_factory)
 
     if args.permanent:
@@ -685,25 +1457,65 @@ def main():
     if args.reporter:
         root = Resource()
         root.putChild(b"", StateResource(flight_observer, feeder_factory,
-                                         downstream_factory, websocket_factory))
+                                         downstream_factory, websocket_factory,
+                                         encoding_cache))
+        root.putChild(b"trail", TrailResource(flight_observer))
+        metrics.REGISTRY.addCollector(lambda: state_metrics(flight_observer, feeder_factory,
+                                                            encoding_cache))
+        root.putChild(b"metrics", MetricsResource())
+        ReactorLag().start()
         webserver = serverFromString(reactor, args.reporter).listen(Site(root))
 
 
     pubSocket = None
     context = zmq.Context()
 
+    # adsb-json and adsb-tile topics only when asked for, not on the
+    # socket made for --ws-workers
+    publishFeatures = bool(args.pubSocket)
+    if args.websocket and args.wsWorkers and not args.pubSocket:
+        args.pubSocket = f"ipc:///tmp/{appName}-pub-{os.getpid()}"
+
     if args.pubSocket:
         pubSocket = context.socket(zmq.PUB)
         pubSocket.bind(args.pubSocket)
 
+    tile_publisher = None
+    if publishFeatures and args.pubTiles:
+        tile_publisher = tiles.TilePublisher(pubSocket, args.pubTiles)
+
+    state_publisher = None
+    if args.websocket and args.wsWorkers:
+        state_publisher = StatePublisher(flight_observer, pubSocket)
+        spawn = multiprocessing.get_context("spawn")
+        options = {k: getattr(args, k) for k in ("logLevel", "logDir", "trailLength", "trailBudget",
+                                                  "wsDeflate", "minLatency", "maxLatency")}
+        options["logLevel"] = level
+        for index in range(args.wsWorkers):
+            spawn.Process(target=run_ws_worker,
+                          args=(index, os.getpid(), args.websocket, args.pubSocket, options),
+                          name=f"ws{index}", daemon=True).start()
+
     dealerSocket = None
     if args.dealerSocket:
         dealerSocket = context.socket(zmq.DEALER)
         dealerSocket.bind(args.dealerSocket)
 
-    lc = LoopingCall(client_updater,
-                     flight_observer, feeder_factory, pubSocket, dealerSocket)
-    lc.start(0.3)
+    UpdateScheduler(flight_observer.getTable(), feeder_factory.clients,
+                    args.minLatency, args.maxLatency,
+                    client_updater, flight_observer, feeder_factory,
+                    pubSocket if publishFeatures else None,
+                    dealerSocket, encoding_cache, state_publisher, tile_publisher).start()
+
+    LoopingCall(flight_observer.cleanObservations).start(EXPIRE_EVERY, now=False)
+    LoopingCall(flight_observer.updateRates).start(observer.OBSERVATION_CLEAN_INTERVAL,
+                                                   now=False)
+
+    if args.snapshot:
+        LoopingCall(save_snapshot, flight_observer, args.snapshot).start(args.snapshotInterval,
+                                                                          now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      save_snapshot, flight_observer, args.snapshot)
 
     setproctitle.setproctitle((f"{appName} "
                                f"logdir={args.logDir} "))
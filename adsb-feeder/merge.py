@@ -0,0 +1,118 @@
+"""
+Merge stage for several upstream feeds
+
+When the same aircraft arrives from several feeds, e.g. a local dump1090
+and ADSBHub, FeedMerger decides which messages reach the FlightObserver:
+
+- while a feed with higher priority delivered the aircraft within the
+  last hold seconds, messages from lower priority feeds are dropped
+  (superseded)
+- a message generated at the same time as the last accepted one of the
+  same aircraft and transmission type from any feed is dropped (duplicate)
+- a message generated before the last accepted one of the same feed is
+  dropped (stale). Receiver clocks differ (see sbs1.generated_timestamp()),
+  so a feed's times are only compared with its own.
+
+Feeds are the UpstreamProtocol instances, which carry a priority and a
+mergestats Counter of the verdicts.
+"""
+
+from typing import *
+from collections import Counter
+import time
+import numpy as np
+
+import sbs1
+
+# seconds a higher priority feed keeps an aircraft to itself
+MERGE_HOLD = 10
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+STALE = 'stale'
+SUPERSEDED = 'superseded'
+
+
+class FeedMerger(object):
+
+    def __init__(self, hold=MERGE_HOLD):
+        self.hold = hold
+        # icao24 -> [feed, priority, last accepted (monotonic),
+        #            {feed: last generated timestamp by transmission type}]
+        self.aircraft: Dict[int, list] = {}
+
+    def accept(self, feed, m, now=None) -> bool:
+        """Decide on a message as returned by sbs1.parse_bytes(timestamps=True)
+        """
+        try:
+            icao24 = sbs1.icao24_key(m["icao24"])
+        except ValueError:
+            return False
+        if now is None:
+            now = time.monotonic()
+        verdict = self._verdict(feed, getattr(feed, 'priority', 0), icao24,
+                                m["transmissionType"], m["generatedTimestamp"], now)
+        if feed is not None:
+            feed.mergestats[verdict] += 1
+        return verdict is ACCEPTED
+
+    def acceptBatch(self, feed, b: sbs1.Batch, now=None) -> np.ndarray:
+        """Decide on the valid rows of an sbs1.Batch parsed with timestamps=True
+
+        Returns the mask of accepted rows.
+        """
+        accepted = b.valid.copy()
+        if not b.n:
+            return accepted
+        if now is None:
+            now = time.monotonic()
+        priority = getattr(feed, 'priority', 0)
+        verdicts = Counter()
+        rows = np.flatnonzero(b.valid)
+        for row, icao24, t, ts in zip(rows.tolist(),
+                                      b.icao24[rows].tolist(),
+                                      b.transmissionType[rows].tolist(),
+                                      b.generated[rows].tolist()):
+            if ts != ts:
+                ts = None  # NaN, no usable date fields
+            verdict = self._verdict(feed, priority, icao24, t, ts, now)
+            if verdict is not ACCEPTED:
+                accepted[row] = False
+            verdicts[verdict] += 1
+        if feed is not None:
+            feed.mergestats.update(verdicts)
+        return accepted
+
+    def _verdict(self, feed, priority, icao24, t, ts, now):
+        state = self.aircraft.get(icao24)
+        if state is None:
+            generated = [None] * (sbs1.ALL_CALL_REPLY + 1)
+            generated[t] = ts
+            self.aircraft[icao24] = [feed, priority, now, {feed: generated}]
+            return ACCEPTED
+
+        owner, owner_priority, owner_seen, byFeed = state
+        if owner is not feed:
+            if priority < owner_priority and now - owner_seen < self.hold:
+                return SUPERSEDED
+
+        if ts is not None:
+            for generated in byFeed.values():
+                if generated[t] == ts:
+                    return DUPLICATE
+            generated = byFeed.get(feed)
+            if generated is None:
+                generated = byFeed[feed] = [None] * (sbs1.ALL_CALL_REPLY + 1)
+            last = generated[t]
+            if last is not None and ts < last:
+                return STALE
+            generated[t] = ts
+        state[0] = feed
+        state[1] = priority
+        state[2] = now
+        return ACCEPTED
+
+    def forget(self, icao24s: Iterable[int]):
+        """Drop the state of expired aircraft"""
+        for icao24 in icao24s:
+            self.aircraft.pop(icao24, None)
@@ -0,0 +1,155 @@
+"""
+Counters and histograms for the reporter's /metrics
+
+Values are either recorded where they occur, in REGISTRY's counters and
+histograms, or read from the running state when scraped, by the
+collectors added with Registry.addCollector(). A collector returns
+Samples and Histograms.
+
+Rendered in the Prometheus text exposition format, or as JSON.
+"""
+
+from typing import *
+from bisect import bisect_left
+from collections import namedtuple
+import math
+import orjson
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# seconds
+PARSE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+TICK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# updates
+QUEUE_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+Sample = namedtuple('Sample', ['name', 'kind', 'help', 'labels', 'value'])
+
+
+class Histogram(object):
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # the last one counts values above all buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float, n: int = 1):
+        """Record value n times, like n lines parsed in value seconds each"""
+        self.counts[bisect_left(self.buckets, value)] += n
+        self.sum += value * n
+        self.count += n
+
+    def take(self) -> Tuple[List[int], float, int]:
+        """Return and reset the counts, sum and count, for add() elsewhere"""
+        state = (self.counts, self.sum, self.count)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        return state
+
+    def add(self, counts: List[int], sum: float, count: int):
+        """Add another histogram's take() with the same buckets"""
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.sum += sum
+        self.count += count
+
+    def prometheus(self) -> List[str]:
+        lines = []
+        total = 0
+        for le, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            le = "+Inf" if le == math.inf else repr(float(le))
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {total}')
+        lines.append(f'{self.name}_sum {self.sum!r}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+    def as_dict(self) -> dict:
+        return {"buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+                "sum": self.sum,
+                "count": self.count}
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for k, v in sorted(labels.items())) + "}"
+
+
+class Registry(object):
+
+    def __init__(self):
+        # (name, sorted label items) -> value
+        self.counters: Dict[tuple, float] = {}
+        # name -> (kind, help)
+        self.descriptions: Dict[str, tuple] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.collectors: List[Callable[[], Iterable]] = []
+
+    def describe(self, name: str, help: str, kind: str = COUNTER):
+        self.descriptions[name] = (kind, help)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float]) -> Histogram:
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram(name, help, buckets)
+        return h
+
+    def addCollector(self, collector: Callable[[], Iterable]):
+        self.collectors.append(collector)
+
+    def collect(self) -> Tuple[List[Sample], List[Histogram]]:
+        samples = []
+        for (name, labels), value in self.counters.items():
+            kind, help = self.descriptions.get(name, (COUNTER, ""))
+            samples.append(Sample(name, kind, help, dict(labels), value))
+        histograms = list(self.histograms.values())
+        for collector in self.collectors:
+            for item in collector():
+                if isinstance(item, Histogram):
+                    histograms.append(item)
+                else:
+                    samples.append(item)
+        return samples, histograms
+
+    def prometheus(self) -> bytes:
+        samples, histograms = self.collect()
+        lines = []
+        described = set()
+        for s in sorted(samples, key=lambda s: s.name):
+            if s.name not in described:
+                described.add(s.name)
+                lines.append(f"# HELP {s.name} {s.help}")
+                lines.append(f"# TYPE {s.name} {s.kind}")
+            lines.append(f"{s.name}{_labels(s.labels)} {s.value!r}")
+        for h in histograms:
+            lines.append(f"# HELP {h.name} {h.help}")
+            lines.append(f"# TYPE {h.name} {HISTOGRAM}")
+            lines.extend(h.prometheus())
+        return ("\n".join(lines) + "\n").encode()
+
+    def json(self) -> bytes:
+        samples, histograms = self.collect()
+        d = {}
+        for s in samples:
+            d.setdefault(s.name, []).append({"labels": s.labels, "value": s.value})
+        for h in histograms:
+            d[h.name] = h.as_dict()
+        return orjson.dumps(d, option=orjson.OPT_SORT_KEYS)
+
+
+REGISTRY = Registry()
@@ -32,214 +32,672 @@ import time
 import re
 import errno
 import sbs1
+import spatialindex
+import federation
+from sbs1 import F_CALLSIGN, F_SQUAWK, F_ALTITUDE, F_SPEED, F_TRACK, F_POSITION, F_VRATE
 from collections import Counter
 import geojson
+import numpy as np
+import heapq
+import itertools
 
-# Clean out observations this often
+# Rates on the status page are averaged over this many seconds
 OBSERVATION_CLEAN_INTERVAL = 30
 
+# Forget aircraft not heard from for this many seconds
+OBSERVATION_EXPIRE_AFTER = 30
+
 log = None
 trace_parser = False
 
-# http://stackoverflow.com/questions/1165352/fast-comparison-between-two-python-dictionary
+# fields required before an aircraft is sent to clients
+PRESENTABLE = F_CALLSIGN | F_ALTITUDE | F_SPEED | F_TRACK | F_POSITION
+
+# Position history: points kept per aircraft, seconds between points, and
+# the number of points kept for all aircraft together
+TRAIL_LENGTH = 120
+TRAIL_INTERVAL = 5
+TRAIL_BUDGET = 1200000
+
+
+class TrailStore(object):
+    """
+    Ring buffers of recent positions for up to budget points.
 
+    The pool is divided into slots of length points; an aircraft gets a
+    slot with its first position and keeps it until it expires. When all
+    slots are taken, further aircraft have no trail. A point is recorded
+    at most every interval seconds.
 
-class DictDiffer(object):
+    The buffers grow by doubling as slots are handed out, so a process
+    tracking few aircraft doesn't hold the whole budget.
     """
-    Calculate the difference between two dictionaries as:
-    (1) items added
-    (2) items removed
-    (3) keys same in both but changed values
-    (4) keys same in both and unchanged values
+
+    def __init__(self, length=TRAIL_LENGTH, budget=TRAIL_BUDGET,
+                 interval=TRAIL_INTERVAL, capacity=64):
+        self.length = length
+        self.interval = interval
+        self.slots = budget // length
+        self.capacity = 0
+        self.used = 0  # slots ever handed out
+        self.free = []
+        # lon, lat, altitude in meters
+        self.points = np.zeros((0, length, 3), dtype=np.float32)
+        self.times = np.zeros((0, length), dtype=np.float64)
+        self.head = np.zeros(0, dtype=np.int32)
+        self.count = np.zeros(0, dtype=np.int32)
+        self.last = np.zeros(0)
+        self.grow(min(capacity, self.slots))
+
+    def grow(self, capacity: int):
+        for name in ("points", "times", "head", "count", "last"):
+            old = getattr(self, name)
+            column = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            column[:self.capacity] = old
+            setattr(self, name, column)
+        self.capacity = capacity
+
+    def allocate(self) -> Optional[int]:
+        if self.free:
+            slot = self.free.pop()
+        elif self.used < self.slots:
+            slot = self.used
+            self.used += 1
+            if slot == self.capacity:
+                self.grow(min(2 * self.capacity or 1, self.slots))
+        else:
+            return None
+        self.head[slot] = 0
+        self.count[slot] = 0
+        self.last[slot] = -np.inf
+        return slot
+
+    def release(self, slot: int):
+        self.free.append(slot)
+
+    def append(self, slot, lat, lon, altitude, now):
+        if now - self.last[slot] < self.interval:
+            return
+        head = self.head[slot]
+        self.points[slot, head] = (lon, lat, altitude * 0.3048)
+        self.times[slot, head] = now
+        self.head[slot] = (head + 1) % self.length
+        self.count[slot] = min(self.count[slot] + 1, self.length)
+        self.last[slot] = now
+
+    def appendBatch(self, slots, lat, lon, altitude, now):
+        """Like append() for arrays, slots must be unique"""
+        due = now - self.last[slots] >= self.interval
+        slots = slots[due]
+        head = self.head[slots]
+        self.points[slots, head, 0] = lon[due]
+        self.points[slots, head, 1] = lat[due]
+        self.points[slots, head, 2] = altitude[due] * 0.3048
+        self.times[slots, head] = now
+        self.head[slots] = (head + 1) % self.length
+        self.count[slots] = np.minimum(self.count[slots] + 1, self.length)
+        self.last[slots] = now
+
+    def get(self, slot: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Points and times of a slot, oldest first"""
+        n = self.count[slot]
+        index = (self.head[slot] - n + np.arange(n)) % self.length
+        return self.points[slot, index], self.times[slot, index]
+
+
+class AircraftTable(object):
+    """
+    Struct-of-arrays state of all observed aircraft, one row per aircraft.
+
+    Rows are handed out on first sight and recycled after the aircraft
+    expired. The Observation objects in observations are views onto a row
+    and are the only per-aircraft Python objects.
+
+    Times are time.monotonic() seconds, wallOffset converts them to epoch.
+    Expiry uses a lazy-deletion heap of (deadline, seq, icao24, observation)
+    entries: an entry is only pushed when an aircraft appears, and when it
+    pops while the aircraft was heard meanwhile it is pushed again with
+    the new deadline. With expire_after None aircraft are only removed by
+    remove().
+
+    trails, if not None, is a TrailStore recording positions, the trail
+    column holds each row's slot + 1.
     """
 
-    def __init__(self, current_dict, past_dict):
-        self.current_dict, self.past_dict = current_dict, past_dict
-        self.set_current, self.set_past = set(
-            current_dict.keys()), set(past_dict.keys())
-        self.intersect = self.set_current.intersection(self.set_past)
+    # present holds the sbs1.F_* bits of the fields observed so far, a
+    # column value is only meaningful if its bit is set. dirty holds the
+    # bits of the fields changed since the last resetUpdated(). version is
+    # the value of the table-wide changes counter at a row's last change, so
+    # it also differs between an expired and a reappearing aircraft.
+    # resetVersion is the version at the last resetUpdated(), the state the
+    # dirty bits are relative to.
+    columns = [
+        ("icao24", np.uint32),
+        ("present", np.uint8),
+        ("dirty", np.uint8),
+        ("flightID", "S12"),
+        ("callsign", "S8"),
+        ("squawk", np.uint16),
+        ("altitude", np.int32),
+        ("groundSpeed", np.float64),
+        ("track", np.float64),
+        ("lat", np.float64),
+        ("lon", np.float64),
+        ("verticalRate", np.int32),
+        ("lastSeen", np.float64),
+        ("altitudeTime", np.float64),
+        ("latLonTime", np.float64),
+        ("trail", np.int32),
+        ("version", np.uint64),
+        ("resetVersion", np.uint64),
+    ]
+
+    def __init__(self, capacity=1024, expire_after=OBSERVATION_EXPIRE_AFTER,
+                 trails=None):
+        self.capacity = capacity
+        self.trails = trails
+        self.size = 0  # rows ever used
+        self.free = []
+        self.observations: Dict[int, Observation] = {}
+        self.expire_after = expire_after
+        self.expiry = []
+        self.seq = itertools.count()
+        self.wallOffset = time.time() - time.monotonic()
+        self.changes = 0
+        # icao24s removed, collected only while this is a list
+        self.removed = None
+        for name, dtype in self.columns:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+    def __len__(self):
+        return len(self.observations)
+
+    def grow(self):
+        self.capacity *= 2
+        for name, dtype in self.columns:
+            column = np.zeros(self.capacity, dtype=dtype)
+            column[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, column)
+
+    def add(self, icao24: int, now: float) -> "Observation":
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self.grow()
+            row = self.size
+            self.size += 1
+        for name, dtype in self.columns:
+            column = getattr(self, name)
+            # b'' for the bytes columns, 0 would be stored as b'0'
+            column[row] = column.dtype.type()
+        self.icao24[row] = icao24
+        self.lastSeen[row] = now
+        o = self.observations[icao24] = Observation(self, row)
+        if self.expire_after is not None:
+            heapq.heappush(self.expiry, (now + self.expire_after, next(self.seq), icao24, o))
+        return o
+
+    def remove(self, icao24: int):
+        o = self.observations.pop(icao24)
+        if self.removed is not None:
+            self.removed.append(icao24)
+        self.present[o._row] = 0
+        self.dirty[o._row] = 0
+        # so indexes like spatialindex.AircraftGrid drop the row
+        self.changes += 1
+        if self.trail[o._row]:
+            self.trails.release(int(self.trail[o._row]) - 1)
+            self.trail[o._row] = 0
+        self.free.append(o._row)
+
+    def expire(self, now: float) -> List[int]:
+        """Remove aircraft not seen for expire_after seconds
+
+        Returns their icao24 addresses.
+        """
+        expired = []
+        expiry = self.expiry
+        while expiry and expiry[0][0] <= now:
+            deadline, seq, icao24, o = heapq.heappop(expiry)
+            if self.observations.get(icao24) is not o:
+                # removed meanwhile, maybe seen again since
+                continue
+            deadline = self.lastSeen[o._row] + self.expire_after
+            if deadline > now:
+                heapq.heappush(expiry, (deadline, next(self.seq), icao24, o))
+                continue
+            self.remove(icao24)
+            expired.append(icao24)
+        return expired
+
+    def rows(self, icao24s: np.ndarray, now: float) -> np.ndarray:
+        """Map an array of icao24 addresses to rows, adding unseen aircraft"""
+        observations = self.observations
+        keys = icao24s.tolist()
+        for icao24 in keys:
+            if icao24 not in observations:
+                self.add(icao24, now)
+        return np.fromiter((observations[k]._row for k in keys),
+                           dtype=np.intp, count=len(keys))
+
+    def update(self, row: int, sbs1msg, now: float):
+        """Apply a message as returned by sbs1.parse_bytes()
+        """
+        self.lastSeen[row] = now
+        bits = 0
+        changed = 0
+        v = sbs1msg["callsign"]
+        if v:
+            bits |= F_CALLSIGN
+            v = v.encode('ascii', 'replace')[:8]
+            if v != self.callsign[row]:
+                self.callsign[row] = v
+                changed |= F_CALLSIGN
+        v = sbs1msg["squawk"]
+        # four digits, like sbs1.parse_lines()
+        if v and len(v) <= 4 and v.isdigit():
+            bits |= F_SQUAWK
+            v = int(v)
+            if v != self.squawk[row]:
+                self.squawk[row] = v
+                changed |= F_SQUAWK
+        v = sbs1msg["flightID"]
+        if v:
+            v = v.encode('ascii', 'replace')
+            if v != self.flightID[row]:
+                self.flightID[row] = v
+        v = sbs1msg["altitude"]
+        if v:
+            bits |= F_ALTITUDE
+            self.altitudeTime[row] = now
+            if v != self.altitude[row]:
+                self.altitude[row] = v
+                changed |= F_ALTITUDE
+        v = sbs1msg["groundSpeed"]
+        if v:
+            bits |= F_SPEED
+            if v != self.groundSpeed[row]:
+                self.groundSpeed[row] = v
+                changed |= F_SPEED
+        v = sbs1msg["track"]
+        if v:
+            bits |= F_TRACK
+            if v != self.track[row]:
+                self.track[row] = v
+                changed |= F_TRACK
+        lat = sbs1msg["lat"]
+        lon = sbs1msg["lon"]
+        if lat and lon:
+            bits |= F_POSITION
+            self.latLonTime[row] = now
+            if lat != self.lat[row] or lon != self.lon[row]:
+                self.lat[row] = lat
+                self.lon[row] = lon
+                changed |= F_POSITION
+                if self.trails is not None:
+                    self.recordTrail(row, now)
+        v = sbs1msg["verticalRate"]
+        if v:
+            bits |= F_VRATE
+            if v != self.verticalRate[row]:
+                self.verticalRate[row] = v
+                changed |= F_VRATE
+        if bits:
+            self.present[row] |= bits
+        if changed:
+            self.dirty[row] |= changed
+            self.changes += 1
+            self.version[row] = self.changes
+
+    def updateBatch(self, rows: np.ndarray, b: sbs1.Batch, sel: np.ndarray, now: float):
+        """Apply the rows sel of an sbs1.Batch to the table rows rows
+
+        If an aircraft appears several times in a batch the last value wins.
+        """
+        present = b.present[sel]
+        self.lastSeen[rows] = now
+
+        def apply(bit, name, values, mask):
+            mask &= (present & bit) != 0
+            which = np.flatnonzero(mask)
+            if not len(which):
+                return which
+            r = rows[which]
+            v = values[which]
+            column = getattr(self, name)
+            changed = r[column[r] != v]
+            column[r] = v
+            np.bitwise_or.at(self.present, r, bit)
+            np.bitwise_or.at(self.dirty, changed, bit)
+            if len(changed):
+                self.changes += 1
+                self.version[changed] = self.changes
+            return r
 
-    def added(self):
-        return self.set_current - self.intersect
+        callsign = np.char.rstrip(b.callsign[sel])
+        apply(F_CALLSIGN, "callsign", callsign, callsign != b'')
+        flightID = b.flightID[sel]
+        given = flightID != b''
+        self.flightID[rows[given]] = flightID[given]
+        apply(F_SQUAWK, "squawk", b.squawk[sel], np.ones(len(rows), dtype=bool))
+        r = apply(F_ALTITUDE, "altitude", b.altitude[sel], b.altitude[sel] != 0)
+        self.altitudeTime[r] = now
+        speed = b.speed[sel]
+        apply(F_SPEED, "groundSpeed", speed, speed != 0)
+        track = b.track[sel]
+        apply(F_TRACK, "track", track, track != 0)
+        lat = b.lat[sel]
+        lon = b.lon[sel]
+        mask = (lat != 0) & (lon != 0)
+        apply(F_POSITION, "lat", lat, mask.copy())
+        r = apply(F_POSITION, "lon", lon, mask)
+        self.latLonTime[r] = now
+        if self.trails is not None and len(r):
+            self.recordTrails(np.unique(r), now)
+        vrate = b.vrate[sel]
+        apply(F_VRATE, "verticalRate", vrate, vrate != 0)
 
-    def removed(self):
-        return self.set_past - self.intersect
+    def _trailSlot(self, row: int) -> int:
+        slot = self.trail[row] - 1
+        if slot < 0:
+            slot = self.trails.allocate()
+            if slot is None:
+                return -1
+            self.trail[row] = slot + 1
+        return slot
 
-    def changed(self):
-        return set(o for o in self.intersect if self.past_dict[o] != self.current_dict[o])
+    def recordTrail(self, row: int, now: float):
+        slot = self._trailSlot(row)
+        if slot >= 0:
+            self.trails.append(slot, self.lat[row], self.lon[row],
+                               self.altitude[row], now)
 
-    def unchanged(self):
-        return set(o for o in self.intersect if self.past_dict[o] == self.current_dict[o])
+    def recordTrails(self, rows: np.ndarray, now: float):
+        """recordTrail() for an array of unique rows"""
+        for row in rows[self.trail[rows] == 0].tolist():
+            self._trailSlot(row)
+        rows = rows[self.trail[rows] > 0]
+        self.trails.appendBatch(self.trail[rows] - 1, self.lat[rows],
+                                self.lon[rows], self.altitude[rows], now)
+
+    # columns kept in a snapshot, times are stored as epoch seconds
+    snapshotColumns = ["icao24", "present", "flightID", "callsign", "squawk",
+                       "altitude", "groundSpeed", "track", "lat", "lon",
+                       "verticalRate", "lastSeen", "altitudeTime", "latLonTime"]
+    timeColumns = ["lastSeen", "altitudeTime", "latLonTime"]
+
+    def snapshot(self, rows: np.ndarray = None, columns: List[str] = None) -> np.ndarray:
+        """The given rows, all live rows by default, as a structured array
+        of the given columns, snapshotColumns by default
+        """
+        types = dict(self.columns)
+        if rows is None:
+            rows = np.fromiter((o._row for o in self.observations.values()),
+                               dtype=np.intp, count=len(self.observations))
+        if columns is None:
+            columns = self.snapshotColumns
+        snap = np.zeros(len(rows), dtype=[(name, types[name]) for name in columns])
+        for name in columns:
+            snap[name] = getattr(self, name)[rows]
+        for name in self.timeColumns:
+            snap[name] += self.wallOffset
+        return snap
+
+    def takeUpdated(self) -> np.ndarray:
+        """snapshot() of the updated() rows including their dirty bits,
+        which are left alone
+        """
+        return self.snapshot(self.updated(), self.snapshotColumns + ["dirty"])
+
+    def takeDirty(self) -> np.ndarray:
+        """snapshot() of the rows changed since the last call, including
+        their dirty bits, and reset those
+        """
+        rows = np.flatnonzero(self.dirty[:self.size])
+        snap = self.snapshot(rows, self.snapshotColumns + ["dirty"])
+        self.dirty[rows] = 0
+        return snap
+
+    def apply(self, snap: np.ndarray, now: float):
+        """Overwrite rows with those of a takeDirty() array, adding unseen
+        aircraft, and merge the dirty bits
+        """
+        if not len(snap):
+            return
+        rows = self.rows(snap["icao24"], now)
+        for name in self.snapshotColumns:
+            getattr(self, name)[rows] = snap[name]
+        for name in self.timeColumns:
+            getattr(self, name)[rows] -= self.wallOffset
+        self.dirty[rows] |= snap["dirty"]
+        self.changes += 1
+        self.version[rows] = self.changes
+        if self.trails is not None:
+            moved = rows[(snap["dirty"] & F_POSITION) != 0]
+            if len(moved):
+                self.recordTrails(moved, now)
+
+    def restore(self, snap: np.ndarray, now: float) -> int:
+        """Add the aircraft of a snapshot() not expired by now
+
+        Restored rows are marked dirty so clients receive them on the next
+        update. Aircraft already present are left alone. Returns the number
+        of aircraft added.
+        """
+        lastSeen = snap["lastSeen"] - self.wallOffset
+        keep = np.flatnonzero(lastSeen + self.expire_after > now)
+        added = 0
+        for i, icao24 in zip(keep.tolist(), snap["icao24"][keep].tolist()):
+            if icao24 in self.observations:
+                continue
+            row = self.add(icao24, lastSeen[i])._row
+            for name in self.snapshotColumns:
+                getattr(self, name)[row] = snap[name][i]
+            for name in self.timeColumns:
+                getattr(self, name)[row] -= self.wallOffset
+            self.dirty[row] = self.present[row]
+            self.changes += 1
+            self.version[row] = self.changes
+            added += 1
+        return added
+
+    def presentable(self, rows: np.ndarray) -> np.ndarray:
+        return (self.present[rows] & PRESENTABLE) == PRESENTABLE
+
+    def updated(self) -> np.ndarray:
+        """The rows of presentable aircraft with dirty bits set"""
+        n = self.size
+        return np.flatnonzero((self.dirty[:n] != 0) &
+                              ((self.present[:n] & PRESENTABLE) == PRESENTABLE))
 
 
 class Observation(object):
     """
     This class keeps track of the observed flights around us.
+
+    It is a view of one row of an AircraftTable, see there.
     """
-    __icao24 = None
-    __squawk = None
-    __flightID = None
-    __loggedDate = None
-    __callsign = None
-    __altitude = None
-    __altitudeTime = None
-    __groundSpeed = None
-    __track = None
-    __lat = None
-    __lon = None
-    __latLonTime = None
-    __verticalRate = None
-    __operator = None
-    __registration = None
-    __type = None
-    __updated = None
-    __route = None
-    __image_url = None
-    __transmission_types = dict()
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table: AircraftTable, row: int):
+        self._table = table
+        self._row = row
+
+    def _has(self, bit):
+        return self._table.present[self._row] & bit
 
     @property
     def __geo_interface__(self):
+        t = self._table
+        row = self._row
+        altitude = int(t.altitude[row])
         return {
             'type': 'Feature',
             'properties':    {
-                "i": self.__icao24,
-                "c": self.__callsign,
-                "s": self.__squawk,
-                "t": self.__altitudeTime.timestamp(),
-                "v": self.__groundSpeed,
-                "r": self.__verticalRate,
-                "h": self.__track,
-                "a": self.__altitude
+                "i": self.getIcao24(),
+                "c": self.getcallsign(),
+                "s": self.getsquawk(),
+                "t": float(t.altitudeTime[row]) + t.wallOffset,
+                "v": self.getGroundSpeed(),
+                "r": self.getVerticalRate(),
+                "h": self.getHeading(),
+                "a": altitude
             },
             'geometry': {
                 'type': 'Point',
-                'coordinates': (self.__lon, self.__lat, float(self.__altitude) * 0.3048)
+                'coordinates': (self.getLon(), self.getLat(), altitude * 0.3048)
             }
         }
 
-    def __repr__(self):
-        return f" icao {self.__icao24} logged {self.__loggedDate} alt {self.__altitude} lat {self.__lat} lon {self.__lon} speed {self.__groundSpeed} track {self.__track}"
+    def delta_interface(self, dirty: int) -> dict:
+        """Like __geo_interface__, but with only the properties whose
+        sbs1.F_* bit is set in dirty, plus the icao24
 
-    def __init__(self, sbs1msg, now):
-        if trace_parser:
-            log.debug("%s appeared" % sbs1msg["icao24"])
-        self.__icao24 = sbs1msg["icao24"]
-        self.__flightID = sbs1msg["flightID"]
-        self.__squawk = sbs1msg["squawk"]
-        self.__loggedDate = now  # sbs1msg["loggedDate"]
-        self.__callsign = sbs1msg["callsign"]
-        self.__altitude = sbs1msg["altitude"]
-        self.__altitudeTime = now
-        self.__groundSpeed = sbs1msg["groundSpeed"]  # mah not present
-        self.__track = sbs1msg["track"]
-        self.__lat = sbs1msg["lat"]
-        self.__lon = sbs1msg["lon"]
-        self.__latLonTime = now
-        self.__verticalRate = sbs1msg["verticalRate"]
-        self.__operator = None
-        self.__registration = None
-        self.__type = None
-        self.__updated = True
-
-    def update(self, sbs1msg, now):
-        oldData = dict(self.__dict__)
-        self.__loggedDate = now
-        if sbs1msg["icao24"]:
-            self.__icao24 = sbs1msg["icao24"]
-        if sbs1msg["squawk"]:
-            self.__squawk = sbs1msg["squawk"]
-        if sbs1msg["flightID"]:
-            self.__flightID = sbs1msg["flightID"]
-        if sbs1msg["callsign"] and self.__callsign != sbs1msg["callsign"]:
-            self.__callsign = sbs1msg["callsign"].rstrip()
-        if sbs1msg["altitude"]:
-            self.__altitude = sbs1msg["altitude"]
-            self.__altitudeTime = now
-        if sbs1msg["groundSpeed"]:
-            self.__groundSpeed = sbs1msg["groundSpeed"]
-        if sbs1msg["track"]:
-            self.__track = sbs1msg["track"]
-        if sbs1msg["lat"]:
-            self.__lat = sbs1msg["lat"]
-            self.__latLonTime = now
-        if sbs1msg["lon"]:
-            self.__lon = sbs1msg["lon"]
-            self.__latLonTime = now
-        if sbs1msg["verticalRate"]:
-            self.__verticalRate = sbs1msg["verticalRate"]
-        if not self.__verticalRate:
-            self.__verticalRate = 0
-        if sbs1msg["generatedDate"]:
-            self.__generatedDate = sbs1msg["generatedDate"]
-        # if sbs1msg["loggedDate"]:
-        #    self.__loggedDate = sbs1msg["loggedDate"]
-
-        # Check if observation was updated
-        newData = dict(self.__dict__)
-        del oldData["_Observation__loggedDate"]
-        del newData["_Observation__loggedDate"]
-        d = DictDiffer(oldData, newData)
-        self.__updated = len(d.changed()) > 0
+        The geometry is always included.
+        """
+        t = self._table
+        row = self._row
+        altitude = int(t.altitude[row])
+        properties = {"i": self.getIcao24()}
+        if dirty & F_CALLSIGN:
+            properties["c"] = self.getcallsign()
+        if dirty & F_SQUAWK:
+            properties["s"] = self.getsquawk()
+        if dirty & F_ALTITUDE:
+            properties["t"] = float(t.altitudeTime[row]) + t.wallOffset
+            properties["a"] = altitude
+        if dirty & F_SPEED:
+            properties["v"] = self.getGroundSpeed()
+        if dirty & F_VRATE:
+            properties["r"] = self.getVerticalRate()
+        if dirty & F_TRACK:
+            properties["h"] = self.getHeading()
+        return {
+            'type': 'Feature',
+            'properties': properties,
+            'geometry': {
+                'type': 'Point',
+                'coordinates': (self.getLon(), self.getLat(), altitude * 0.3048)
+            }
+        }
+
+    def trail_interface(self) -> Optional[dict]:
+        """The recorded positions as a GeoJSON LineString Feature, oldest
+        first, with their epoch times in the 'ts' property. None if there
+        is no trail.
+        """
+        t = self._table
+        slot = t.trail[self._row] - 1
+        if slot < 0:
+            return None
+        points, times = t.trails.get(slot)
+        return {
+            'type': 'Feature',
+            'properties': {
+                "i": self.getIcao24(),
+                "ts": [round(ts + t.wallOffset, 1) for ts in times.tolist()]
+            },
+            'geometry': {
+                'type': 'LineString',
+                # float32 resolution, roughly a meter
+                'coordinates': [(round(lon, 5), round(lat, 5), round(alt))
+                                for lon, lat, alt in points.tolist()]
+            }
+        }
+
+    def __repr__(self):
+        return f" icao {self.getIcao24()} logged {self.getLoggedDate()} alt {self.getAltitude()} lat {self.getLat()} lon {self.getLon()} speed {self.getGroundSpeed()} track {self.getHeading()}"
 
     def getIcao24(self) -> str:
-        return self.__icao24
+        return sbs1.icao24_str(int(self._table.icao24[self._row]))
 
     def getcallsign(self) -> str:
-        return self.__callsign
+        if not self._has(F_CALLSIGN):
+            return ""
+        return self._table.callsign[self._row].decode('ascii', 'replace').rstrip()
 
     def getsquawk(self) -> str:
-        return self.__squawk
+        if not self._has(F_SQUAWK):
+            return ""
+        return f"{self._table.squawk[self._row]:04d}"
 
     def getflightID(self) -> str:
-        return self.__flightID
+        return self._table.flightID[self._row].decode('ascii', 'replace')
 
     def getLat(self) -> float:
-        return self.__lat
+        if not self._has(F_POSITION):
+            return None
+        return float(self._table.lat[self._row])
 
     def getLon(self) -> float:
-        return self.__lon
+        if not self._has(F_POSITION):
+            return None
+        return float(self._table.lon[self._row])
 
     def isUpdated(self) -> bool:
-        return self.__updated
+        return bool(self._table.dirty[self._row])
+
+    def getDirty(self) -> int:
+        """sbs1.F_* bits of the fields changed since resetUpdated()"""
+        return int(self._table.dirty[self._row])
+
+    def getRow(self) -> int:
+        """The AircraftTable row, reused after the aircraft expired"""
+        return self._row
+
+    def getVersion(self) -> int:
+        return int(self._table.version[self._row])
+
+    def getResetVersion(self) -> int:
+        """The version at the last resetUpdated(), a delta of the dirty
+        bits only completes a client holding this version
+        """
+        return int(self._table.resetVersion[self._row])
 
     def resetUpdated(self):
-        self.__updated = False
+        self._table.dirty[self._row] = 0
+        self._table.resetVersion[self._row] = self._table.version[self._row]
 
     def getLoggedDate(self) -> datetime:
-        return self.__loggedDate
+        return datetime.utcfromtimestamp(self._table.lastSeen[self._row] +
+                                         self._table.wallOffset)
 
     def getGroundSpeed(self) -> float:
-        return round(self.__groundSpeed, 1)
+        if not self._has(F_SPEED):
+            return None
+        return round(float(self._table.groundSpeed[self._row]), 1)
 
     def getHeading(self) -> float:
-        return round(self.__track, 1)
+        if not self._has(F_TRACK):
+            return None
+        return round(float(self._table.track[self._row]), 1)
 
     def getAltitude(self) -> float:
-        return self.__altitude
+        if not self._has(F_ALTITUDE):
+            return None
+        return int(self._table.altitude[self._row])
 
     def getVerticalRate(self) -> float:
-        return self.__verticalRate
+        return int(self._table.verticalRate[self._row])
 
     def getType(self) -> str:
-        return self.__type
+        return None
 
     def getRegistration(self) -> str:
-        return self.__registration
+        return None
 
     def getOperator(self) -> str:
-        return self.__operator
+        return None
 
     def getRoute(self) -> str:
-        return self.__route
+        return None
 
     def getImageUrl(self) -> str:
-        return self.__image_url
+        return None
 
     def isPresentable(self) -> bool:
-        if not (self.__altitude and self.__lat and self.__lon):
-            return False
-        # return self.__altitude and self.__groundSpeed and self.__track and self.__lat and self.__lon and self.__operator and self.__registration and self.__image_url
-        return self.__altitude and self.__lat and self.__lon and self.__callsign and self.__groundSpeed and self.__track
+        return (self._table.present[self._row] & PRESENTABLE) == PRESENTABLE
 
     def as_dict(self) -> dict:
         d = {
@@ -272,23 +730,8 @@ class Observation(object):
         feature = geojson.Feature(geometry=point, properties=properties)
         return feature
 
-    def dict(self):
-        d = dict(self.__dict__)
-        if d["_Observation__verticalRate"] == None:
-            d["verticalRate"] = 0
-        if "_Observation__lastAlt" in d:
-            del d["lastAlt"]
-        if "_Observation__lastLat" in d:
-            del d["lastLat"]
-        if "_Observation__lastLon" in d:
-            del d["lastLon"]
-        d["loggedDate"] = "%s" % (d["_Observation__loggedDate"])
-        return d
-
 
 class FlightObserver(object):
-    __observations: Dict[str, str] = {}
-    __next_clean: datetime = None
     __msgTypes = {
         1: 'ES_IDENT_AND_CATEGORY',
         2: 'ES_SURFACE_POS',
@@ -299,32 +742,143 @@ class FlightObserver(object):
         7: 'AIR_TO_AIR',
         8: 'ALL_CALL_REPLY'
     }
-    __msgByType = Counter()
-    __counters = Counter(messages=0, observations=0)
 
-    def __init__(self):
-        self.__observations = {}
-        self.__next_clean = datetime.utcnow() + timedelta(seconds=OBSERVATION_CLEAN_INTERVAL)
+    def __init__(self, expire_after=OBSERVATION_EXPIRE_AFTER, merger=None,
+                 trail_length=TRAIL_LENGTH, trail_budget=TRAIL_BUDGET):
+        """
+        Expiry and rates are not updated by parsing, run
+        cleanObservations() and updateRates() periodically.
+
+        merger, if given, is a merge.FeedMerger which decides per message
+        whether it is applied, see there.
+
+        trail_budget is the number of trail points kept for all aircraft,
+        0 disables trails, see TrailStore.
+
+        expire_after None disables expiry, for the mirror of shard workers'
+        state, see shard.py.
+        """
+        trails = None
+        if trail_budget >= trail_length > 0:
+            trails = TrailStore(trail_length, trail_budget)
+        self.__table = AircraftTable(expire_after=expire_after, trails=trails)
+        # per observer, shard workers' and mirrors' counts stay apart
+        self.__msgByType = Counter()
+        self.__counters = Counter(messages=0, observations=0, errors=0, ignored=0)
+        # __counters accumulated by updateRates()
+        self.__totals = Counter()
+        self.__observations = self.__table.observations
+        self.__grid = None
         self.__message_rate = 0.
         self.__observation_rate = 0.
+        self.merger = merger
 
-    def parse(self, data):
-        now = datetime.utcnow()
+    def parse(self, data: bytes, feed=None):
+        """Parse and apply an SBS-1 line received from feed
+
+        Returns the Observation if it is presentable.
+        """
         self.__counters['messages'] += 1
-        self.cleanObservations(now)
-        m = sbs1.parse(data)
-        if m:
-            self.__msgByType[m["transmissionType"]] += 1
-            icao24 = m["icao24"]
-            if icao24 in self.__observations:
-                self.__observations[icao24].update(m, now)
+        merger = self.merger
+        m = sbs1.parse_bytes(data, timestamps=merger is not None)
+        if m is None:
+            if data.lstrip().startswith(b'MSG,'):
+                self.countErrors(feed, 1)
             else:
-                self.__observations[icao24] = Observation(m, now)
+                # AIR, ID, STA, SEL, CLK records and blank lines
+                self.__counters['ignored'] += 1
+            return None
+        if merger is None:
+            return self.observe(m)
+        if merger.accept(feed, m):
+            return self.observe(m)
+        return None
+
+    def countErrors(self, feed, n: int):
+        """Count n unparsable MSG lines, also in feed.feedstats if feed has
+        them
+        """
+        self.__counters['errors'] += n
+        stats = getattr(feed, 'feedstats', None)
+        if stats is not None:
+            stats['errors'] += n
 
-            if self.__observations[icao24].isPresentable():
-                self.__counters['observations'] += 1
-                return self.__observations[icao24]
+    def observeFeature(self, feature: dict, feed=None):
+        """Apply a GeoJSON feature received from another adsb-feeder's
+        client_updater, see federation
+
+        Returns the Observation if it is presentable.
+        """
+        self.__counters['messages'] += 1
+        m = federation.feature_message(feature)
+        if self.merger is not None and not self.merger.accept(feed, m):
+            return None
+        return self.observe(m)
+
+    def observe(self, m, now=None):
+        """Apply a message as returned by sbs1.parse_bytes()
+
+        Returns the Observation if it is presentable.
+        """
+        if not m:
+            return None
+        if now is None:
+            now = time.monotonic()
+        try:
+            icao24 = sbs1.icao24_key(m["icao24"])
+        except ValueError:
             return None
+        self.__msgByType[m["transmissionType"]] += 1
+        o = self.__observations.get(icao24)
+        if o is None:
+            if trace_parser:
+                log.debug("%s appeared" % m["icao24"])
+            o = self.__table.add(icao24, now)
+        self.__table.update(o._row, m, now)
+
+        if o.isPresentable():
+            self.__counters['observations'] += 1
+            return o
+        return None
+
+    def parseLines(self, lines: List[bytes], feed=None) -> int:
+        """Parse and apply a list of complete SBS-1 lines in one pass
+
+        Returns the number of lines.
+        """
+        merger = self.merger
+        b = sbs1.parse_lines(lines, timestamps=merger is not None)
+        self.__counters['messages'] += b.lines
+        errors = b.msgs - int(np.count_nonzero(b.valid))
+        if errors:
+            self.countErrors(feed, errors)
+        self.__counters['ignored'] += b.lines - b.msgs
+        if merger is None:
+            self.observeBatch(b)
+        else:
+            self.observeBatch(b, merger.acceptBatch(feed, b))
+        return b.lines
+
+    def observeBatch(self, b: sbs1.Batch, valid: np.ndarray = None, now=None):
+        """Apply the rows of an sbs1.Batch selected by the boolean mask
+        valid, all valid rows by default
+        """
+        if not b.n:
+            return
+        if valid is None:
+            valid = b.valid
+        if now is None:
+            now = time.monotonic()
+
+        for t, count in enumerate(np.bincount(b.transmissionType[valid],
+                                              minlength=sbs1.ALL_CALL_REPLY + 1)):
+            if count:
+                self.__msgByType[t] += int(count)
+
+        sel = np.flatnonzero(valid)
+        rows = self.__table.rows(b.icao24[sel], now)
+        self.__table.updateBatch(rows, b, sel, now)
+        self.__counters['observations'] += int(self.__table.presentable(rows).sum())
 
     def _distribution(self):
         s = sum(self.__msgByType.values())
@@ -340,30 +894,137 @@ class FlightObserver(object):
         }
         return (r, self._distribution(), self.__observations, OBSERVATION_CLEAN_INTERVAL)
 
-    def getObservations(self):
+    def getObservations(self) -> Dict[int, Observation]:
         return self.__observations
 
-    def cleanObservations(self, now):
+    def getUpdated(self) -> List[Tuple[int, Observation]]:
+        """(icao24, Observation) of the presentable aircraft changed since
+        their last resetUpdated()
+
+        Found from the table's dirty column, so the cost doesn't grow with
+        the number of unchanged aircraft visited in Python.
+        """
+        table = self.__table
+        observations = self.__observations
+        return [(icao24, observations[icao24])
+                for icao24 in table.icao24[table.updated()].tolist()]
+
+    def getWithin(self, bbox) -> List[Tuple[int, Observation]]:
+        """(icao24, Observation) of the presentable aircraft within a
+        boundingbox.BoundingBox
+        """
+        if self.__grid is None:
+            self.__grid = spatialindex.AircraftGrid(self.__table)
+        table = self.__table
+        observations = self.__observations
+        rows = self.__grid.query(bbox)
+        if bbox.shape is not None:
+            contains = bbox.shape.contains
+            rows = rows[np.fromiter((contains(lat, lon) for lat, lon in
+                                     zip(table.lat[rows].tolist(), table.lon[rows].tolist())),
+                                    dtype=bool, count=len(rows))]
+        return [(icao24, observations[icao24])
+                for icao24 in table.icao24[rows].tolist()]
+
+    def getTrail(self, icao24: int) -> Optional[dict]:
+        """The trail of an aircraft, see Observation.trail_interface()"""
+        o = self.__observations.get(icao24)
+        if o is None:
+            return None
+        return o.trail_interface()
+
+    def saveSnapshot(self, path: str):
+        """Write the aircraft state to path (a .npy file)
+
+        The file is written next to path and renamed, so readers never see
+        a partial snapshot.
+        """
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, self.__table.snapshot())
+        os.replace(tmp, path)
+
+    def loadSnapshot(self, path: str, now=None, shard=None) -> int:
+        """Restore the aircraft of a saveSnapshot() file heard within the
+        expiry window
+
+        shard, an (index, count) tuple, restores only the aircraft with
+        icao24 % count == index.
+
+        Returns the number of aircraft restored, 0 if path does not exist or
+        was written with different columns.
+        """
+        if now is None:
+            now = time.monotonic()
+        try:
+            snap = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            return 0
+        if snap.dtype.names != tuple(AircraftTable.snapshotColumns):
+            log.warning(f"snapshot {path} has unexpected columns {snap.dtype.names}, ignored")
+            return 0
+        if shard is not None:
+            index, count = shard
+            snap = snap[snap["icao24"] % count == index]
+        return self.__table.restore(snap, now)
+
+    def takeCounters(self) -> Tuple[Dict[str, int], Dict[int, int]]:
+        """Return and reset the message and transmission type counters"""
+        counters = dict(self.__counters)
+        byType = dict(self.__msgByType)
+        self.__counters.clear()
+        self.__msgByType.clear()
+        return counters, byType
+
+    def getTotals(self) -> Tuple[Dict[str, int], Dict[int, int]]:
+        """The message, observation and error counts since start, and the
+        messages by transmission type
+        """
+        totals = self.__totals + self.__counters
+        return dict(totals), dict(self.__msgByType)
+
+    def addCounters(self, counters: Dict[str, int], byType: Dict[int, int]):
+        """Add counters returned by another observer's takeCounters()"""
+        self.__counters.update(counters)
+        self.__msgByType.update(byType)
+
+    def applyShard(self, snap: np.ndarray, expired: List[int], now=None):
+        """Mirror a shard worker's update: remove its expired aircraft and
+        apply its AircraftTable.takeDirty() rows
+        """
+        if now is None:
+            now = time.monotonic()
+        table = self.__table
+        for icao24 in expired:
+            if icao24 in self.__observations:
+                table.remove(icao24)
+        table.apply(snap, now)
+
+    def getTable(self) -> AircraftTable:
+        return self.__table
+
+    def cleanObservations(self, now=None) -> List[int]:
         """Clean observations for planes not seen in a while
+
+        Returns the icao24 addresses removed.
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = self.__table.expire(now)
+        if trace_parser:
+            for icao24 in expired:
+                log.debug("%s disappeared" % sbs1.icao24_str(icao24))
+        if self.merger is not None:
+            self.merger.forget(expired)
+        return expired
+
+    def updateRates(self):
+        """Average the message counters, call every OBSERVATION_CLEAN_INTERVAL seconds
         """
-        if now > self.__next_clean:
-            cleaned = []
-            for icao24 in self.__observations:
-                if trace_parser:
-                    log.debug("[%s] %s -> %s : %s" % (icao24, self.__observations[icao24].getLoggedDate(
-                    ), self.__observations[icao24].getLoggedDate() + timedelta(seconds=OBSERVATION_CLEAN_INTERVAL), now))
-                if self.__observations[icao24].getLoggedDate() + timedelta(seconds=OBSERVATION_CLEAN_INTERVAL) < now:
-                    if trace_parser:
-                        log.debug("%s disappeared" % (icao24))
-                    cleaned.append(icao24)
-
-            for icao24 in cleaned:
-                del self.__observations[icao24]
-
-            self.__next_clean = now + \
-                timedelta(seconds=OBSERVATION_CLEAN_INTERVAL)
-            self.__message_rate = float(
-                self.__counters['messages']) / OBSERVATION_CLEAN_INTERVAL
-            self.__observation_rate = float(
-                self.__counters['observations']) / OBSERVATION_CLEAN_INTERVAL
-            self.__counters.clear()
+        self.__message_rate = float(
+            self.__counters['messages']) / OBSERVATION_CLEAN_INTERVAL
+        self.__observation_rate = float(
+            self.__counters['observations']) / OBSERVATION_CLEAN_INTERVAL
+        self.__totals.update(self.__counters)
+        self.__counters.clear()
+        self.__table.wallOffset = time.time() - time.monotonic()
@@ -0,0 +1,270 @@
+"""
+Sharded observer: spread parsing and observing over worker processes
+
+With --workers N the upstream protocols don't parse themselves. ShardRouter
+routes each line by icao24 % N to one of N worker processes over a ZMQ
+PUSH socket. Every worker owns the aircraft of its shard in its own
+FlightObserver, and every TICK seconds pushes back the rows changed since
+its last tick (AircraftTable.takeDirty()), the aircraft it expired and its
+message counters.
+
+The fan-out process applies those to a mirror FlightObserver without
+expiry of its own, which client_updater, trails, snapshots and the
+reporter use as before.
+
+Line messages are [feed id, priority, lines joined by newline], a feed's
+connection closing is [feed id, CLOSED], updates are [orjson header, rows
+of the structured array]. Feed ids count up and are never reused. The
+header also carries the merge verdicts and parse errors per feed and the
+parse time histogram, which the router adds to the feeds and parse_time.
+"""
+
+from typing import *
+from collections import Counter
+import itertools
+import multiprocessing
+import weakref
+import time
+import os
+import logging
+import numpy as np
+import orjson
+import zmq
+import setproctitle
+
+import observer
+import merge
+import metrics
+import sbs1
+
+log = None
+
+# seconds between updates from a worker
+TICK = 0.1
+# line messages queued per worker before dropping
+QUEUE_LIMIT = 10000
+# second frame of the message telling workers to forget a feed
+CLOSED = b"closed"
+
+
+class ShardFeed(object):
+    """Stand-in for an UpstreamProtocol inside a worker, for merge.FeedMerger"""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.mergestats = Counter()
+        self.feedstats = Counter(errors=0)
+
+
+class ShardRouter(object):
+
+    def __init__(self, flight_observer, count, socketPrefix, options, parse_time=None):
+        """
+        Start count workers, talking over socketPrefix-<n> and
+        socketPrefix-updates, like ipc:///tmp/adsb-feeder-shard
+
+        options is a dict of run_worker() keyword arguments. parse_time, a
+        metrics.Histogram with metrics.PARSE_BUCKETS, gets the workers'
+        parse times per line.
+        """
+        self.observer = flight_observer
+        self.parse_time = parse_time
+        self.count = count
+        self.context = zmq.Context.instance()
+        # feed id -> feed, feed -> feed id
+        self.feeds = weakref.WeakValueDictionary()
+        self.feedIDs = weakref.WeakKeyDictionary()
+        self.nextFeedID = itertools.count(1)
+        # (socket, feed id) of CLOSED messages not sent yet
+        self.closing = []
+        self.dropped = 0
+
+        self.updates = self.context.socket(zmq.PULL)
+        self.updates.bind(f"{socketPrefix}-updates")
+        self.sockets = []
+        self.workers = []
+        spawn = multiprocessing.get_context("spawn")
+        for index in range(count):
+            socket = self.context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.SNDHWM, QUEUE_LIMIT)
+            # connecting queues lines until the worker is up and bound
+            socket.connect(f"{socketPrefix}-{index}")
+            self.sockets.append(socket)
+            worker = spawn.Process(target=run_worker,
+                                   args=(index, count, f"{socketPrefix}-{index}",
+                                         f"{socketPrefix}-updates", os.getpid()),
+                                   kwargs=options,
+                                   name=f"shard{index}",
+                                   daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def route(self, lines: List[bytes], feed):
+        """Send complete SBS-1 lines received from feed to their workers"""
+        count = self.count
+        shards = [[] for _ in range(count)]
+        unroutable = []
+        for line in lines:
+            fields = line.split(b',', 5)
+            try:
+                shards[sbs1.icao24_key(fields[4]) % count].append(line)
+            except (IndexError, ValueError):
+                unroutable.append(line)
+        if unroutable:
+            # counted here as the workers would
+            errors = sum(1 for line in unroutable if line.lstrip().startswith(b'MSG,'))
+            self.observer.addCounters({"messages": len(unroutable),
+                                       "ignored": len(unroutable) - errors}, {})
+            if errors:
+                self.observer.countErrors(feed, errors)
+
+        feedID = self.feedIDs.get(feed)
+        if feedID is None:
+            feedID = self.feedIDs[feed] = str(next(self.nextFeedID)).encode()
+            self.feeds[feedID] = feed
+        priority = str(getattr(feed, 'priority', 0)).encode()
+        for socket, shard in zip(self.sockets, shards):
+            if not shard:
+                continue
+            try:
+                socket.send_multipart([feedID, priority, b"\n".join(shard)],
+                                      flags=zmq.NOBLOCK)
+            except zmq.Again:
+                self.dropped += len(shard)
+
+    def close(self, feed):
+        """Tell the workers to forget a feed, call when its connection is lost"""
+        feedID = self.feedIDs.pop(feed, None)
+        if feedID is None:
+            return
+        self.feeds.pop(feedID, None)
+        self.closing.extend((socket, feedID) for socket in self.sockets)
+        self.sendClosing()
+
+    def sendClosing(self):
+        closing = self.closing
+        self.closing = []
+        for socket, feedID in closing:
+            try:
+                socket.send_multipart([feedID, CLOSED], flags=zmq.NOBLOCK)
+            except zmq.Again:
+                self.closing.append((socket, feedID))
+
+    def receive(self):
+        """Apply all pending worker updates to the mirror observer"""
+        if self.closing:
+            self.sendClosing()
+        while True:
+            try:
+                header, rows = self.updates.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            header = orjson.loads(header)
+            snap = np.frombuffer(rows, dtype=snapshotType())
+            self.observer.applyShard(snap, header["x"])
+            self.observer.addCounters(header["c"],
+                                      {int(t): n for t, n in header["t"].items()})
+            for feedID, stats in header["s"].items():
+                feed = self.feeds.get(feedID.encode())
+                if feed is not None:
+                    feed.mergestats.update(stats["m"])
+                    feed.feedstats['errors'] += stats["e"]
+            if self.parse_time is not None and "p" in header:
+                self.parse_time.add(*header["p"])
+
+    def stop(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join(1)
+
+
+def snapshotType() -> np.dtype:
+    types = dict(observer.AircraftTable.columns)
+    return np.dtype([(name, types[name])
+                     for name in observer.AircraftTable.snapshotColumns + ["dirty"]])
+
+
+def run_worker(index, count, linesAddress, updatesAddress, parent,
+               expire_after=observer.OBSERVATION_EXPIRE_AFTER, merge_feeds=False,
+               batch=False, snapshot=None, setup_logging=None, appName="adsb-feeder",
+               logLevel=logging.WARNING, logDir="/tmp"):
+    """Worker process main loop, exits when parent is gone"""
+    global log
+    name = f"{appName}-shard{index}"
+    if setup_logging is not None:
+        setup_logging(logLevel, name, logDir)
+    log = logging.getLogger(name)
+    observer.log = log
+    setproctitle.setproctitle(f"{name} logdir={logDir}")
+
+    context = zmq.Context()
+    lines = context.socket(zmq.PULL)
+    lines.bind(linesAddress)
+    updates = context.socket(zmq.PUSH)
+    updates.connect(updatesAddress)
+
+    merger = merge.FeedMerger() if merge_feeds else None
+    flight_observer = observer.FlightObserver(expire_after=expire_after,
+                                              merger=merger, trail_budget=0)
+    if snapshot:
+        try:
+            restored = flight_observer.loadSnapshot(snapshot, shard=(index, count))
+            log.info(f"restored {restored} aircraft from {snapshot}")
+        except Exception as e:
+            log.error(f"failed to load snapshot {snapshot}: {e}")
+    table = flight_observer.getTable()
+    feeds: Dict[bytes, ShardFeed] = {}
+    parseTime = metrics.Histogram("parse", "", metrics.PARSE_BUCKETS)
+
+    log.debug(f"shard {index}/{count} started")
+    nextTick = time.monotonic() + TICK
+    while os.getppid() == parent:
+        timeout = max(0., nextTick - time.monotonic())
+        while lines.poll(timeout * 1000):
+            timeout = 0
+            message = lines.recv_multipart()
+            if len(message) == 2:
+                # CLOSED
+                feeds.pop(message[0], None)
+                continue
+            feedID, priority, data = message
+            feed = feeds.get(feedID)
+            if feed is None:
+                feed = feeds[feedID] = ShardFeed(int(priority))
+            feed.priority = int(priority)
+            started = time.perf_counter()
+            if batch:
+                n = flight_observer.parseLines(data.split(b"\n"), feed)
+            else:
+                n = 0
+                for line in data.split(b"\n"):
+                    flight_observer.parse(line, feed)
+                    n += 1
+            if n:
+                parseTime.observe((time.perf_counter() - started) / n, n)
+            if time.monotonic() >= nextTick:
+                break
+
+        now = time.monotonic()
+        if now < nextTick:
+            continue
+        nextTick = now + TICK
+        expired = flight_observer.cleanObservations(now)
+        counters, byType = flight_observer.takeCounters()
+        stats = {}
+        for feedID, feed in feeds.items():
+            if feed.mergestats or feed.feedstats['errors']:
+                stats[feedID.decode()] = {"m": dict(feed.mergestats),
+                                          "e": feed.feedstats['errors']}
+                feed.mergestats.clear()
+                feed.feedstats['errors'] = 0
+        snap = table.takeDirty()
+        if not (len(snap) or expired or counters or stats):
+            continue
+        header = {"x": expired, "c": counters, "t": byType, "s": stats}
+        if parseTime.count:
+            header["p"] = parseTime.take()
+        header = orjson.dumps(header, option=orjson.OPT_NON_STR_KEYS)
+        updates.send_multipart([header, snap.tobytes()])
+    log.debug(f"shard {index}/{count} exiting, parent gone")
@@ -0,0 +1,151 @@
+"""
+Grid index of client bounding boxes
+
+client_updater asks for the clients whose bounding box may contain an
+aircraft's position instead of testing every client. The world is divided
+into cells of CELL_SIZE degrees; a client is filed under every cell its
+bbox touches. Boxes spanning more than MAX_CELLS cells, like the default
+match-all box, are kept in a separate list which is always returned.
+
+Candidates still need the exact test (main.within()), the grid ignores
+altitude and cell borders.
+
+AircraftGrid is the reverse, an index of aircraft positions queried by a
+client's bbox, for the snapshot sent when a client connects or changes it.
+"""
+
+from typing import *
+import math
+import numpy as np
+
+# degrees per grid cell
+CELL_SIZE = 1.0
+# boxes touching more cells are not filed per cell
+MAX_CELLS = 2000
+
+
+class BBoxIndex(object):
+
+    def __init__(self, cell_size=CELL_SIZE, max_cells=MAX_CELLS):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.rows = math.ceil(180 / cell_size)
+        self.columns = math.ceil(360 / cell_size)
+        # cell number -> clients
+        self.cells: Dict[int, list] = {}
+        self.wide = []
+        # client -> cell numbers, None if in wide
+        self.filed: Dict[object, Optional[List[int]]] = {}
+
+    def __len__(self):
+        return len(self.filed)
+
+    def _row(self, lat):
+        return min(max(int((lat + 90) // self.cell_size), 0), self.rows - 1)
+
+    def _column(self, lon):
+        return min(max(int((lon + 180) // self.cell_size), 0), self.columns - 1)
+
+    def add(self, client):
+        """File client under its client.bbox"""
+        if client in self.filed:
+            self.remove(client)
+        bbox = client.bbox
+        if (bbox.min_latitude > bbox.max_latitude or
+                bbox.min_longitude > bbox.max_longitude):
+            # matches nothing
+            self.filed[client] = []
+            return
+        rows = range(self._row(bbox.min_latitude), self._row(bbox.max_latitude) + 1)
+        columns = range(self._column(bbox.min_longitude),
+                        self._column(bbox.max_longitude) + 1)
+        if len(rows) * len(columns) > self.max_cells:
+            self.wide.append(client)
+            self.filed[client] = None
+            return
+        cells = [r * self.columns + c for r in rows for c in columns]
+        for cell in cells:
+            self.cells.setdefault(cell, []).append(client)
+        self.filed[client] = cells
+
+    def remove(self, client):
+        cells = self.filed.pop(client, [])
+        if cells is None:
+            self.wide.remove(client)
+            return
+        for cell in cells:
+            clients = self.cells[cell]
+            clients.remove(client)
+            if not clients:
+                del self.cells[cell]
+
+    # a bbox change is a re-add
+    update = add
+
+    def candidates(self, lat: float, lon: float) -> list:
+        """The clients whose bbox may contain lat/lon"""
+        clients = self.cells.get(self._row(lat) * self.columns + self._column(lon))
+        if clients is None:
+            return self.wide
+        if not self.wide:
+            return clients
+        return self.wide + clients
+
+
+class AircraftGrid(object):
+    """Grid index of the presentable aircraft positions of an AircraftTable
+
+    The rows are sorted by grid cell, a query only looks at the cell ranges
+    its bbox covers. The index is rebuilt on the first query after the
+    table changed, at most once per change of AircraftTable.changes.
+    """
+
+    def __init__(self, table, cell_size=CELL_SIZE):
+        self.table = table
+        self.cell_size = cell_size
+        self.columns = math.ceil(360 / cell_size)
+        self.rows = math.ceil(180 / cell_size)
+        self.changes = None
+        self.order = np.zeros(0, dtype=np.intp)
+        self.cells = np.zeros(0, dtype=np.int64)
+
+    def _cell(self, lat, lon):
+        r = np.clip(((lat + 90) // self.cell_size).astype(np.int64), 0, self.rows - 1)
+        c = np.clip(((lon + 180) // self.cell_size).astype(np.int64), 0, self.columns - 1)
+        return r * self.columns + c
+
+    def build(self):
+        t = self.table
+        rows = np.flatnonzero(t.presentable(np.arange(t.size)))
+        cells = self._cell(t.lat[rows], t.lon[rows])
+        order = np.argsort(cells, kind='stable')
+        self.order = rows[order]
+        self.cells = cells[order]
+        self.changes = t.changes
+
+    def query(self, bbox) -> np.ndarray:
+        """The table rows of presentable aircraft within bbox"""
+        if self.changes != self.table.changes:
+            self.build()
+        if (bbox.min_latitude > bbox.max_latitude or
+                bbox.min_longitude > bbox.max_longitude or not len(self.cells)):
+            return np.zeros(0, dtype=np.intp)
+        lo = self._cell(np.array([bbox.min_latitude]), np.array([bbox.min_longitude]))[0]
+        hi = self._cell(np.array([bbox.max_latitude]), np.array([bbox.max_longitude]))[0]
+        r0, c0 = divmod(int(lo), self.columns)
+        r1, c1 = divmod(int(hi), self.columns)
+        starts = np.arange(r0, r1 + 1) * self.columns + c0
+        ends = np.arange(r0, r1 + 1) * self.columns + c1
+        first = np.searchsorted(self.cells, starts, 'left')
+        last = np.searchsorted(self.cells, ends, 'right')
+        rows = np.concatenate([self.order[f:l] for f, l in zip(first, last)
+                               if l > f] or [np.zeros(0, dtype=np.intp)])
+        t = self.table
+        # rows removed since the build are no longer presentable
+        rows = rows[t.presentable(rows)]
+        lat = t.lat[rows]
+        lon = t.lon[rows]
+        alt = t.altitude[rows]
+        return rows[(lat >= bbox.min_latitude) & (lat <= bbox.max_latitude) &
+                    (lon >= bbox.min_longitude) & (lon <= bbox.max_longitude) &
+                    (alt >= bbox.min_altitude) & (alt <= bbox.max_altitude)]
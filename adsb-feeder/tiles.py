@@ -0,0 +1,112 @@
+"""
+Geo-tiled ZMQ topics
+
+With --pub-tiles N client_updater publishes on topics naming an altitude
+band and the geohash of precision N of each aircraft's position instead
+of the single topic adsb-json:
+
+    adsb-tile/<band>/<geohash>
+
+Band n holds altitudes (ft) below ALTITUDE_BANDS[n], the last band the
+rest. A tick's updates of a tile go out as one multipart message, the
+topic followed by one JSON feature per frame.
+
+ZMQ SUB sockets match topics by prefix, so subscribers pick areas and
+bands at the socket: adsb-tile/3/u2 is every aircraft above 30000 ft in
+geohash u2, at any publishing precision. covering() lists the
+subscriptions of a bounding box, see subscriber.py.
+
+Kept free of server imports for subscribers.
+"""
+
+from typing import *
+
+TOPIC = b'adsb-tile/'
+# ft, upper limits of the bands but the last
+ALTITUDE_BANDS = [10000, 20000, 30000]
+BANDS = len(ALTITUDE_BANDS) + 1
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def band(alt) -> int:
+    """The altitude band of alt, 0 if unknown"""
+    if alt is None:
+        return 0
+    for n, limit in enumerate(ALTITUDE_BANDS):
+        if alt < limit:
+            return n
+    return len(ALTITUDE_BANDS)
+
+
+def geohash(lat: float, lon: float, precision: int) -> str:
+    bits = precision * 5
+    latBits = bits // 2
+    lonBits = bits - latBits
+    y = min(max(int((lat + 90) / 180 * (1 << latBits)), 0), (1 << latBits) - 1)
+    x = min(max(int((lon + 180) / 360 * (1 << lonBits)), 0), (1 << lonBits) - 1)
+    # interleave, longitude first
+    h = 0
+    for k in range(bits):
+        if k & 1:
+            h = (h << 1) | ((y >> (latBits - 1 - k // 2)) & 1)
+        else:
+            h = (h << 1) | ((x >> (lonBits - 1 - k // 2)) & 1)
+    return ''.join(_BASE32[(h >> shift) & 31] for shift in range(bits - 5, -1, -5))
+
+
+def topic(lat: float, lon: float, alt, precision: int) -> bytes:
+    return TOPIC + f"{band(alt)}/{geohash(lat, lon, precision)}".encode()
+
+
+def covering(min_lat: float, max_lat: float, min_lon: float, max_lon: float,
+             precision: int, bands: Iterable[int] = None) -> List[bytes]:
+    """The topic prefixes to subscribe to for a bounding box, by geohashes
+    of precision, for all bands unless given
+    """
+    bits = precision * 5
+    dlat = 180 / (1 << (bits // 2))
+    dlon = 360 / (1 << (bits - bits // 2))
+    hashes = set()
+    lat = min_lat
+    while True:
+        lon = min_lon
+        while True:
+            hashes.add(geohash(min(lat, max_lat), min(lon, max_lon), precision))
+            if lon >= max_lon:
+                break
+            lon += dlon
+        if lat >= max_lat:
+            break
+        lat += dlat
+    if bands is None:
+        bands = range(BANDS)
+    return sorted(TOPIC + f"{b}/{h}".encode() for b in bands for h in hashes)
+
+
+class TilePublisher(object):
+    """Collects a tick's features by topic and publishes them"""
+
+    def __init__(self, socket, precision: int):
+        self.socket = socket
+        self.precision = precision
+        # topic -> [topic, feature, ...]
+        self.pending: Dict[bytes, List[bytes]] = {}
+
+    def add(self, lat: float, lon: float, alt, feature: bytes):
+        t = topic(lat, lon, alt, self.precision)
+        message = self.pending.get(t)
+        if message is None:
+            self.pending[t] = [t, feature]
+        else:
+            message.append(feature)
+
+    def flush(self) -> Tuple[int, int]:
+        """Publish the pending messages, returns their number and bytes"""
+        size = 0
+        for message in self.pending.values():
+            self.socket.send_multipart(message)
+            size += sum(map(len, message))
+        count = len(self.pending)
+        self.pending = {}
+        return count, size
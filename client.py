@@ -1,4 +1,5 @@
 import sys
+import os
 import requests
 import geobuf
 import base64
@@ -11,6 +12,9 @@ from autobahn.twisted.websocket import WebSocketClientFactory, \
     WebSocketClientProtocol, \
     connectWS
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'adsb-feeder'))
+import binproto
+
 # sent as dynamic bbox update once session established
 bbox = {
     "min_latitude": 46,
@@ -33,19 +37,26 @@ class ADSBFeederClientProtocol(WebSocketClientProtocol):
 
         # after 2 seconds send a bbox update
         reactor.callLater(2, self.sendBBox)
+        # adsb-bin state, icao24 -> properties
+        self.aircraft = {}
 
     def onConnect(self, response):
         print(f"onConnect response={response} proto={self.websocket_protocol_in_use}")
 
     def onMessage(self, payload, isBinary):
-        if self.websocket_protocol_in_use == 'adsb-geobuf':
+        if self.websocket_protocol_in_use in ('adsb-geobuf', 'adsb-geobuf-batch'):
             msg = geobuf.decode(payload)
             print(f"geobuf received: isBinary={isBinary} msg={msg}")
 
-        if self.websocket_protocol_in_use == 'adsb-json':
+        if self.websocket_protocol_in_use in ('adsb-json', 'adsb-json-batch'):
             msg = json.loads(payload.decode('utf8'))
             print(f"json received: isBinary={isBinary} msg={msg}")
 
+        if self.websocket_protocol_in_use == 'adsb-bin':
+            # records only carry what changed, merged into the known state
+            for aircraft in binproto.merge(self.aircraft, payload):
+                print(f"adsb-bin received: {aircraft}")
+
     def onClose(self, wasClean, code, reason):
         print(f"WebSocket connection closed: wasClean={wasClean} code={code} reason={reason}")
 
@@ -66,7 +77,9 @@ if __name__ == '__main__':
                         action='store',
                         type=str,
                         default=None,
-                        help="Websocket subprotocol to use, like adsb-geobuf or adsb-json")
+                        help="Websocket subprotocol to use, like adsb-geobuf or adsb-json, "
+                        "or their -batch variants sending a FeatureCollection per update, "
+                        "or the binary delta records of adsb-bin")
 
     args = parser.parse_args()
     headers = []
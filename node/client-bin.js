@@ -0,0 +1,88 @@
+const WebSocket = require('ws');
+
+var args = process.argv.slice(2);
+console.log('args: ', args);
+
+var uri = args[0];
+var bbox = {
+    "min_latitude": 46,
+    "max_latitude": 47,
+    "min_longitude": 13,
+    "max_longitude": 17,
+    "min_altitude": -100,
+    "max_altitude": 10000000
+};
+
+// adsb-bin record layout, see adsb-feeder/binproto.py
+const VERSION = 1;
+const EPOCH = 1704067200;
+const F_CALLSIGN = 0x01, F_SQUAWK = 0x02, F_ALTITUDE = 0x04, F_SPEED = 0x08,
+      F_TRACK = 0x10, F_POSITION = 0x20, F_VRATE = 0x40, F_TIME = 0x80;
+
+// icao24 -> properties, records only carry what changed
+var aircraft = {};
+
+function decode(buffer) {
+    const view = new DataView(buffer);
+    if (view.getUint8(0) !== VERSION)
+        throw new Error("not an adsb-bin version " + VERSION + " message");
+    var records = [];
+    var offset = 1;
+    while (offset < view.byteLength) {
+        const head = view.getUint32(offset, true);
+        const mask = head >>> 24;
+        offset += 4;
+        var d = {i: (head & 0xffffff).toString(16).toUpperCase().padStart(6, '0')};
+        if (mask & F_CALLSIGN) {
+            d.c = String.fromCharCode(...new Uint8Array(buffer, offset, 8)).trimEnd();
+            offset += 8;
+        }
+        if (mask & F_SQUAWK) {
+            d.s = view.getUint16(offset, true).toString().padStart(4, '0');
+            offset += 2;
+        }
+        if (mask & F_ALTITUDE) {
+            d.a = view.getInt16(offset, true) * 25;
+            offset += 2;
+        }
+        if (mask & F_SPEED) {
+            d.v = view.getUint16(offset, true) / 10;
+            offset += 2;
+        }
+        if (mask & F_TRACK) {
+            d.h = view.getUint16(offset, true) / 100;
+            offset += 2;
+        }
+        if (mask & F_POSITION) {
+            d.lat = view.getInt32(offset, true) / 1e5;
+            d.lon = view.getInt32(offset + 4, true) / 1e5;
+            offset += 8;
+        }
+        if (mask & F_VRATE) {
+            d.r = view.getInt16(offset, true);
+            offset += 2;
+        }
+        if (mask & F_TIME) {
+            d.t = view.getUint32(offset, true) / 10 + EPOCH;
+            offset += 4;
+        }
+        records.push(d);
+    }
+    return records;
+}
+
+const ws = new WebSocket(uri, ['adsb-bin']);
+ws.binaryType = "arraybuffer";
+ws.on('open', function open() {
+    console.log("connection opened, sending bounding box");
+    // example for dynamically changing the bbox of the updates
+    ws.send(JSON.stringify(bbox));
+});
+
+ws.on('message', function incoming(data) {
+    for (const d of decode(data)) {
+        const state = Object.assign(aircraft[d.i] || {}, d);
+        aircraft[d.i] = state;
+        console.log(state);
+    }
+});
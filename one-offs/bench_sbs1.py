@@ -0,0 +1,64 @@
+"""
+compare sbs1.parse() (str, all fields) with sbs1.parse_bytes() (bytes, per
+transmission type fields)
+
+run like:
+
+python one-offs/bench_sbs1.py [recorded-feed.txt]
+
+without an argument a synthetic mix roughly matching data.adsbhub.org:5002
+is used.
+"""
+import sys
+import os
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'adsb-feeder'))
+import sbs1
+
+# transmission type distribution as shown on the reporter page
+MIX = [(3, 38), (4, 30), (5, 14), (6, 6), (1, 5), (8, 4), (7, 2), (2, 1)]
+
+TEMPLATES = {
+    1: "MSG,1,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,OEF123  ,,,,,,,,0,0,0,0",
+    2: "MSG,2,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,,0,12.0,271.3,48.1102,16.5697,,,0,0,0,-1",
+    3: "MSG,3,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,,36000,,,47.12345,15.54321,,,0,0,0,0",
+    4: "MSG,4,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,,,451.2,87.4,,,-640,,0,0,0,0",
+    5: "MSG,5,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,,36000,,,,,,,0,,0,0",
+    6: "MSG,6,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,,36000,,,,,,7421,0,0,0,0",
+    7: "MSG,7,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,,36000,,,,,,,,,,0",
+    8: "MSG,8,1,1,{icao},1,2021/01/08,12:34:56.789,2021/01/08,12:34:56.790,,,,,,,,,,,,0",
+}
+
+
+def synthetic(n=100000):
+    types = [t for t, w in MIX for _ in range(w)]
+    icaos = [f"{random.randrange(1 << 24):06X}" for _ in range(5000)]
+    return [TEMPLATES[random.choice(types)].format(icao=random.choice(icaos))
+            for _ in range(n)]
+
+
+def main(argv):
+    if len(argv) > 1:
+        with open(argv[1]) as f:
+            lines = f.read().splitlines()
+    else:
+        lines = synthetic()
+    blines = [l.encode() for l in lines]
+
+    def old():
+        for l in blines:
+            sbs1.parse(l.decode())
+
+    def new():
+        for l in blines:
+            sbs1.parse_bytes(l)
+
+    for name, fn in (("parse", old), ("parse_bytes", new)):
+        t = min(timeit.repeat(fn, number=1, repeat=5))
+        print(f"{name:12s} {len(lines) / t:12,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
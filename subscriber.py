@@ -1,20 +1,48 @@
 #!/usr/bin/env python
 import sys
+import os
+import argparse
 import zmq
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'adsb-feeder'))
+import tiles
+
 feedSocket = "ipc:///tmp/adsb-json-feed"
 topic = b'adsb-json'
 
+
 def main():
+    parser = argparse.ArgumentParser(description='adsb-feeder ZMQ subscriber example')
+    parser.add_argument('--socket', dest='socket', default=feedSocket,
+                        help=f'publishing socket to connect to, default {feedSocket}')
+    parser.add_argument('--tiles', dest='tiles', type=int, default=0,
+                        help='subscribe to the adsb-tile topics of a server run with --pub-tiles, '
+                        'by geohashes of this precision')
+    parser.add_argument('--bbox', dest='bbox', default="-90,90,-180,180",
+                        help='min_latitude,max_latitude,min_longitude,max_longitude '
+                        'to subscribe to with --tiles')
+    parser.add_argument('--bands', dest='bands', default=None,
+                        help='comma separated altitude bands to subscribe to with --tiles, '
+                        f'0-{tiles.BANDS - 1}, bounded by {tiles.ALTITUDE_BANDS} ft')
+    args = parser.parse_args()
+
     ctx = zmq.Context()
     s = ctx.socket(zmq.SUB)
-    s.connect(feedSocket)
-    s.subscribe(topic)
+    s.connect(args.socket)
+    if args.tiles:
+        min_lat, max_lat, min_lon, max_lon = (float(v) for v in args.bbox.split(","))
+        bands = [int(b) for b in args.bands.split(",")] if args.bands else None
+        for t in tiles.covering(min_lat, max_lat, min_lon, max_lon, args.tiles, bands):
+            s.subscribe(t)
+    else:
+        s.subscribe(topic)
 
     try:
         while True:
-            t, msg = s.recv_multipart()
-            print('   Topic: %s, msg:%s' % (t, msg))
+            # tiled topics carry all features of a tile and tick
+            t, *msgs = s.recv_multipart()
+            for msg in msgs:
+                print('   Topic: %s, msg:%s' % (t, msg))
     except KeyboardInterrupt:
         pass
     print("Done.")